@@ -0,0 +1,79 @@
+# bench_coldstart.py
+"""Cold-start benchmark: import + client init + first intent scoring, per request path.
+
+Every sample is a fresh interpreter, so nothing is warm. No network calls are made
+(boto3 clients are built but never used), so numbers are comparable between runs:
+    python bench_coldstart.py [--runs 15] [--json]
+
+"eager" builds every client like the handler used to at import, for comparison.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# clients each path touches on its first turn (see lambda_handler / handle_turn)
+PATHS = {
+    "faq":          (["dynamodb"], "how much should I feed my dog"),
+    "order_status": (["dynamodb", "shopify"], "where is my order jane@example.com"),
+    "fallback":     (["dynamodb", "bedrock"], "do you have cat food"),
+    "escalation":   (["dynamodb", "sns"], "talk to a human please"),
+    "eager":        (["bedrock", "dynamodb", "sns", "shopify"], "how much should I feed my dog"),
+}
+
+CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import lambda_function as lf
+t1 = time.perf_counter()
+init = lf.handle_ping({"ping": True, "init": json.loads(sys.argv[1])})
+t2 = time.perf_counter()
+lf.detect_intent(sys.argv[2])
+t3 = time.perf_counter()
+print(json.dumps({"import_ms": (t1 - t0) * 1e3, "init_ms": (t2 - t1) * 1e3,
+                  "intent_ms": (t3 - t2) * 1e3, "total_ms": (t3 - t0) * 1e3}))
+"""
+
+
+def sample(clients, message):
+    env = {**os.environ, "PYTHONPATH": HERE, "PYTHONDONTWRITEBYTECODE": "1"}
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    out = subprocess.run([sys.executable, "-c", CHILD, json.dumps(clients), message],
+                         cwd=HERE, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+
+def run(runs):
+    results = {}
+    for path, (clients, message) in PATHS.items():
+        samples = [sample(clients, message) for _ in range(runs)]
+        results[path] = {
+            k: {"p50": round(statistics.median(s[k] for s in samples), 2),
+                "p90": round(pct([s[k] for s in samples], 90), 2)}
+            for k in samples[0]
+        }
+    return results
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--runs", type=int, default=15)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+    res = run(args.runs)
+    if args.json:
+        print(json.dumps(res, indent=2))
+    else:
+        cols = ["import_ms", "init_ms", "intent_ms", "total_ms"]
+        print(f"{'path':<14}" + "".join(f"{c + ' p50/p90':>22}" for c in cols))
+        for path, r in res.items():
+            print(f"{path:<14}" + "".join(f"{r[c]['p50']:>12.1f} /{r[c]['p90']:>7.1f}" for c in cols))
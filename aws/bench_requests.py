@@ -0,0 +1,350 @@
+# bench_requests.py
+"""Offline request-path benchmark: lambda_handler end to end with in-process fakes.
+
+DynamoDB, Bedrock, SNS and Shopify are replaced by fakes.py (optionally with a fixed
+per-call delay), and a seeded corpus of English/Chinese FAQ, order-status and fallback
+conversations is replayed through the handler. Reports per-stage and end-to-end latency
+percentiles, CPU time per request, best_faq_match / detect_intent microbenchmarks
+at 1x/10x/100x FAQ bank sizes, and stored bytes per turn plus encode/decode CPU of the
+compact session codec against the plain JSON encoding:
+    python bench_requests.py [--requests 400] [--io-latency 0] [--out base.json]
+    python bench_requests.py --compare base.json
+
+Everything is deterministic for a given --seed, so runs on the same machine are comparable.
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("OUTBOX_FLUSH", "thread")  # time publishing off the request path, as server.py does
+os.environ.setdefault("SNS_TOPIC_ARN", "arn:aws:sns:us-east-1:000000000000:bench")
+os.environ.setdefault("METRICS_EMF", "false")  # keep EMF lines out of the report
+
+import fakes
+import lambda_function as lf
+import session_codec
+
+FAQ_MESSAGES = [
+    "how much should I feed my dog", "what is fresh cooked dog food", "why feed fresh cooked",
+    "when will I receive my delivery", "how do I store the food", "can I pause my subscription",
+    "is the food safe for puppies", "what ingredients do you use", "how long does the food last in the fridge",
+    "do you deliver on weekends", "how do I cancel my plan", "can I change my delivery date",
+    "鲜食的好处", "为什么吃鲜食", "狗狗每天吃多少", "什么时候到货", "怎么保存", "可以暂停订阅吗",
+    "幼犬可以吃吗", "用什么原料",
+]
+ORDER_CONVERSATIONS = [
+    ["where is my order jane@example.com"],
+    ["where is my order", "jane@example.com"],
+    ["我的订单在哪里", "jane@example.com"],
+    ["track my order please", "new@example.com"],
+    ["order status for new@example.com"],
+    ["订单状态", "nobody@example.com"],
+]
+FALLBACK_MESSAGES = [
+    "do you have cat food", "hello there", "are you a real person", "my dog is a picky eater, any tips?",
+    "can I visit your kitchen", "你们有猫粮吗", "你好", "do you ship to Canada",
+    "what is your return policy for opened boxes", "thanks, that's all",
+]
+MIX = {"faq": 0.55, "order_status": 0.25, "fallback": 0.20}
+
+STAGES = ["load_session", "detect_intent", "handle_faq", "handle_order_status",
+          "lookup_order_status", "llm_reply", "commit_session"]
+
+
+def build_corpus(n, seed):
+    """List of conversations (lists of messages) with about n messages in total."""
+    rng = random.Random(seed)
+    convs, total = [], 0
+    while total < n:
+        kind = rng.choices(list(MIX), weights=list(MIX.values()))[0]
+        if kind == "faq":
+            conv = [rng.choice(FAQ_MESSAGES) for _ in range(rng.randint(1, 3))]
+        elif kind == "order_status":
+            conv = list(rng.choice(ORDER_CONVERSATIONS))
+        else:
+            conv = [rng.choice(FALLBACK_MESSAGES)]
+        convs.append(conv)
+        total += len(conv)
+    return convs
+
+
+# ---- per-stage timing ----
+class StageTimer:
+    """Wraps lambda_function's stage functions; handle_turn looks them up as globals at call time."""
+
+    def __init__(self, names):
+        self.names = names
+        self.lock = threading.Lock()
+        self.current = {}
+        self.originals = {}
+
+    def install(self):
+        for name in self.names:
+            fn = self.originals[name] = getattr(lf, name)
+            setattr(lf, name, self._wrap(name, fn))
+
+    def uninstall(self):
+        for name, fn in self.originals.items():
+            setattr(lf, name, fn)
+
+    def _wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                ms = (time.perf_counter() - t) * 1e3
+                with self.lock:
+                    self.current[name] = self.current.get(name, 0.0) + ms
+        return timed
+
+    def take(self):
+        with self.lock:
+            cur, self.current = self.current, {}
+        return cur
+
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+
+def summarize(xs):
+    if not xs:
+        return {"n": 0}
+    return {"n": len(xs), "p50": round(statistics.median(xs), 3), "p90": round(pct(xs, 90), 3),
+            "p99": round(pct(xs, 99), 3), "mean": round(statistics.fmean(xs), 3)}
+
+
+def bench_requests(n, seed, warmup):
+    convs = build_corpus(n, seed)
+    timer = StageTimer(STAGES)
+    timer.install()
+    wall, cpu, stages, by_intent = [], [], {s: [] for s in STAGES}, {}
+    try:
+        for i, conv in enumerate(convs):
+            sid = f"bench-{seed}-{i}"
+            for msg in conv:
+                event = {"body": json.dumps({"session_id": sid, "message": msg})}
+                timer.take()
+                t, c = time.perf_counter(), time.process_time()
+                r = lf.lambda_handler(event, None)
+                w_ms, c_ms = (time.perf_counter() - t) * 1e3, (time.process_time() - c) * 1e3
+                spent = timer.take()
+                if r["statusCode"] != 200:
+                    raise RuntimeError(f"{msg!r}: {r['body']}")
+                if i < warmup:
+                    continue
+                wall.append(w_ms)
+                cpu.append(c_ms)
+                by_intent.setdefault(json.loads(r["body"])["intent"], []).append(w_ms)
+                for s, ms in spent.items():
+                    stages[s].append(ms)
+    finally:
+        timer.uninstall()
+    return {
+        "end_to_end_ms": summarize(wall),
+        "cpu_ms": summarize(cpu),
+        "by_intent_ms": {k: summarize(v) for k, v in sorted(by_intent.items())},
+        "stages_ms": {s: summarize(v) for s, v in stages.items() if v},
+    }
+
+
+# ---- microbenchmarks ----
+def scaled_bank(base, factor, seed):
+    """base repeated `factor` times; copies get perturbed tags so they don't collapse in the index."""
+    if factor == 1:
+        return base
+    rng = random.Random(seed)
+    bank = list(base)
+    for k in range(1, factor):
+        for item in base:
+            item = copy.deepcopy(item)
+            item["q"] = f"{item['q']} ({k})"
+            item["tags"] = [t + " " + "".join(rng.choices("abcdefghij", k=3)) for t in item.get("tags", [])]
+            bank.append(item)
+    return bank
+
+
+def time_calls(fn, inputs, repeat):
+    per_call = []
+    for _ in range(repeat):
+        for x in inputs:
+            t = time.perf_counter()
+            fn(x)
+            per_call.append((time.perf_counter() - t) * 1e3)
+    return summarize(per_call)
+
+
+def bench_micro(factors, seed, repeat):
+    base = lf.FAQS
+    queries = FAQ_MESSAGES + [m for conv in ORDER_CONVERSATIONS for m in conv] + FALLBACK_MESSAGES
+    modes = ["index", "exact"]
+    try:
+        import numpy  # noqa: F401
+        modes.append("tfidf")
+    except ImportError:
+        pass
+    cache_size, lf.FAQ_CACHE.maxsize = lf.FAQ_CACHE.maxsize, 0  # measure scoring, not the cache
+    results = {}
+    try:
+        for f in factors:
+            bank = lf.reload_faqs(scaled_bank(base, f, seed))
+            row = {"faqs": len(bank.faqs)}
+            for mode in modes:
+                lf.best_faq_match(queries[0], mode)  # build the tfidf matrix outside the timing
+                row[f"best_faq_match[{mode}]"] = time_calls(lambda q: lf.best_faq_match(q, mode), queries, repeat)
+            row["detect_intent"] = time_calls(lf.detect_intent, queries, repeat)
+            results[f"{f}x"] = row
+    finally:
+        lf.FAQ_CACHE.maxsize = cache_size
+        lf.reload_faqs(base)
+        lf.FAQ_CACHE.clear()
+    return results
+
+
+# ---- session encoding ----
+def attr_size(name, value):
+    """DynamoDB's billed size of one attribute: name bytes + value bytes (numbers ~1 byte per 2 digits)."""
+    (kind, v), = value.items()
+    if kind == "N":
+        return len(name) + (len(v.lstrip("-").replace(".", "")) + 1) // 2 + 1
+    return len(name) + (len(v) if kind == "B" else len(v.encode("utf-8")))
+
+
+def item_size(item):
+    return sum(attr_size(k, v) for k, v in item.items())
+
+
+def sample_session(n_msgs, seed):
+    """A realistic history: FAQ-style questions answered with FAQ templates, one state blob."""
+    rng = random.Random(seed)
+    history, ts = [], 1760000000
+    for i in range(n_msgs // 2):
+        ts += rng.randint(5, 90)
+        history.append({"role": "user", "content": rng.choice(FAQ_MESSAGES + FALLBACK_MESSAGES), "ts": ts})
+        ts += rng.randint(1, 4)
+        history.append({"role": "assistant", "content": rng.choice(lf.FAQS)["a"], "ts": ts,
+                        "intent": rng.choice(["faq", "faq", "order_status", "fallback"])})
+    state = {"contact": "jane@example.com", "summary": "user: how do I store the food\nassistant: Place meals in the freezer.",
+             "summary_upto": max(0, n_msgs - 8)}
+    return history, state
+
+
+def cpu_us(fn, repeat):
+    t = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return round((time.process_time() - t) / repeat * 1e6, 2)
+
+
+def bench_codec(lengths, seed, repeat):
+    """Blob-store item bytes per turn (user + assistant message) and encode/decode CPU, JSON vs compact;
+    plus the average per-turn-store message item."""
+    results = {}
+    key = {"session_id": {"S": "3f2b8c1e-0d4a-4b6e-9a51-7c2e8f9d1a60"}, "version": {"N": "12"},
+               "updated_at": {"N": "1760000000"}}
+    for n in lengths:
+        history, state = sample_session(n, seed)
+        as_json = {**key, "history": {"S": json.dumps(history, ensure_ascii=False)},
+                   "state": {"S": json.dumps(state, ensure_ascii=False)}}
+        data = session_codec.encode_session(history, state)
+        compact = {**key, "data": {"B": data}}
+        h_json, s_json = as_json["history"]["S"], as_json["state"]["S"]
+        turns = n // 2
+        row = {
+            "json.bytes_per_turn": round(item_size(as_json) / turns, 1),
+            "compact.bytes_per_turn": round(item_size(compact) / turns, 1),
+            "json.encode_us": cpu_us(lambda: (json.dumps(history, ensure_ascii=False),
+                                              json.dumps(state, ensure_ascii=False)), repeat),
+            "compact.encode_us": cpu_us(lambda: session_codec.encode_session(history, state), repeat),
+            "json.decode_us": cpu_us(lambda: (json.loads(h_json), json.loads(s_json)), repeat),
+            "compact.decode_us": cpu_us(lambda: session_codec.decode_session(data), repeat),
+        }
+        row["compact.saved_pct"] = round(100 * (1 - row["compact.bytes_per_turn"] / row["json.bytes_per_turn"]), 1)
+        results[f"{n}msgs"] = row
+    history, _ = sample_session(40, seed)
+    codec = lf.SESSION_CODEC
+    try:
+        per_msg = {}
+        for name in ("json", "compact"):
+            lf.SESSION_CODEC = name
+            items = [lf._turn_item(key["session_id"]["S"], m, i) for i, m in enumerate(history, 1)]
+            per_msg[f"{name}.bytes_per_message"] = round(statistics.fmean(map(item_size, items)), 1)
+    finally:
+        lf.SESSION_CODEC = codec
+    results["turn_store"] = per_msg
+    return results
+
+
+# ---- reporting ----
+def env_info(args):
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "faq_match_mode": lf.FAQ_MATCH_MODE, "session_store": lf.SESSION_STORE,
+            "pipeline_workers": lf.PIPELINE_WORKERS, "session_codec": lf.SESSION_CODEC, "seed": args.seed, "requests": args.requests,
+            "io_latency_ms": args.io_latency}
+
+
+def flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not key.endswith(".n"):
+            out[key] = v
+    return out
+
+
+def print_report(res, baseline=None):
+    flat = flatten({k: v for k, v in res.items() if k != "env"})
+    base = flatten({k: v for k, v in baseline.items() if k != "env"}) if baseline else {}
+    for key, v in flat.items():
+        line = f"{key:<60}{v:>12.3f}"
+        if key in base and base[key]:
+            line += f"{(v - base[key]) / base[key] * 100:>+10.1f}%"
+        print(line)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--requests", type=int, default=400)
+    ap.add_argument("--warmup", type=int, default=10, help="conversations replayed before measuring")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--io-latency", type=float, default=0.0, help="ms added to every fake AWS/Shopify call")
+    ap.add_argument("--factors", default="1,10,100", help="FAQ bank sizes for the microbenchmarks")
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--codec-lengths", default="2,10,40", help="messages per session for the codec benchmark")
+    ap.add_argument("--out", help="write results JSON here")
+    ap.add_argument("--compare", help="baseline JSON from an earlier --out run")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    fakes.install(lf, latency_ms=args.io_latency)
+    res = {"env": env_info(args),
+           "requests": bench_requests(args.requests, args.seed, args.warmup),
+           "micro": bench_micro([int(f) for f in args.factors.split(",")], args.seed, args.repeat),
+           "session_codec": bench_codec([int(n) for n in args.codec_lengths.split(",")], args.seed, 200 * args.repeat)}
+    lf.OUTBOX.drain()
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(res, f, indent=2)
+    if args.json:
+        json.dump(res, sys.stdout, indent=2)
+        print()
+    else:
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+            print(f"comparing against {args.compare} ({baseline.get('env', {}).get('python')})")
+        print_report(res, baseline)
@@ -0,0 +1,56 @@
+# build_brand_tone.py
+"""Precompute brand_tone() rewrites of every FAQ answer into brand_tone_cache.json.
+
+Run before packaging the Lambda (needs Bedrock access for MODEL_ID):
+    python build_brand_tone.py [--out brand_tone_cache.json] [--force]
+
+Entries already built for the current MODEL_ID and answer text are reused unless --force;
+entries for edited/removed answers or another model are dropped. Answers brand_tone() couldn't
+rewrite are left out (containers fall back to rewriting them live) and the script exits 1, so a
+rerun retries just those.
+"""
+import argparse
+import sys
+import json
+from datetime import datetime, timezone
+
+import lambda_function as lf
+
+
+def build(out, force=False):
+    bank = lf.ensure_faqs()  # the bank containers serve: the compiled artifact if there is one
+    existing = {} if force else lf.load_brand_tone_cache(out)
+    entries, rewritten, failed = {}, 0, set()
+    for item in bank.faqs:
+        key = lf.brand_tone_key(item["a"])
+        if key in entries or key in failed:
+            continue
+        toned = existing.get(key)
+        if toned is None:
+            toned = lf.brand_tone(item["a"])
+            if toned == item["a"]:  # brand_tone() returns its input on failure
+                print(f"error: brand_tone returned the template unchanged for {item['q']!r}", file=sys.stderr)
+                failed.add(key)
+                continue
+            rewritten += 1
+        entries[key] = toned
+    artifact = {
+        "version": 1,
+        "model_id": lf.MODEL_ID,
+        "faq_hash": bank.hash,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "entries": entries,
+    }
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(artifact, f, ensure_ascii=False, indent=2)
+    print(f"{len(entries)} entries ({rewritten} rewritten, {len(entries) - rewritten} reused, "
+          f"{len(failed)} failed) -> {out}")
+    return not failed
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--out", default=lf.BRAND_TONE_CACHE_PATH)
+    ap.add_argument("--force", action="store_true", help="rewrite every answer, ignoring the existing artifact")
+    args = ap.parse_args()
+    sys.exit(0 if build(args.out, force=args.force) else 1)
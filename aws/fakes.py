@@ -0,0 +1,170 @@
+# fakes.py
+"""In-process stand-ins for DynamoDB, Bedrock, SNS and Shopify.
+
+They implement just the calls lambda_function makes, with the same request/response
+shapes, so the handler runs unchanged offline (benchmarks, local server, replays):
+    import lambda_function as lf, fakes
+    fakes.install(lf, latency_ms=0)
+Every fake can add a fixed per-call delay to stand in for network time.
+"""
+import copy
+import io
+import json
+import threading
+import time
+
+from shopify_stub import CUSTOMERS, ORDERS, gql_order
+
+
+class _Latency:
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.calls = 0
+
+    def _io(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class ConditionalCheckFailed(Exception):
+    response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+
+
+class FakeDynamo(_Latency):
+    """Items keyed by (table, session_id, sk or None); supports the condition expressions we use."""
+
+    def __init__(self, latency_ms=0.0):
+        super().__init__(latency_ms)
+        self.items = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(table, item):
+        return (table, item["session_id"]["S"], item.get("sk", {}).get("S"))
+
+    def _check(self, cur, expr, values):
+        if expr is None:
+            return True
+        for clause in expr.split(" OR "):
+            clause = clause.strip()
+            if clause.startswith("attribute_not_exists"):
+                attr = clause[clause.index("(") + 1:-1]
+                if cur is None or (attr == "#v" and "version" not in cur):
+                    return True
+            elif clause == "#v = :v":
+                if cur is not None and cur.get("version") == values[":v"]:
+                    return True
+            elif " < " in clause:
+                attr, val = (x.strip() for x in clause.split(" < "))
+                if cur is not None and attr in cur and int(cur[attr]["N"]) < int(values[val]["N"]):
+                    return True
+        return False
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._io()
+        item = self.items.get(self._key(TableName, Key))
+        return {"Item": copy.deepcopy(item)} if item else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self._io()
+        with self.lock:
+            key = self._key(TableName, Item)
+            if not self._check(self.items.get(key), ConditionExpression, ExpressionAttributeValues or {}):
+                raise ConditionalCheckFailed()
+            self.items[key] = copy.deepcopy(Item)
+        return {}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self._io()
+        self.items.pop(self._key(TableName, Key), None)
+        return {}
+
+    def query(self, TableName, ExpressionAttributeValues, ScanIndexForward=True, Limit=None, Select=None, **kwargs):
+        self._io()
+        sid = ExpressionAttributeValues[":s"]["S"]
+        rows = sorted((v for (t, p, _), v in list(self.items.items()) if t == TableName and p == sid),
+                      key=lambda i: i.get("sk", {}).get("S", ""), reverse=not ScanIndexForward)[:Limit]
+        return {"Count": len(rows)} if Select == "COUNT" else {"Items": rows, "Count": len(rows)}
+
+    def batch_write_item(self, RequestItems):
+        self._io()
+        with self.lock:
+            for table, reqs in RequestItems.items():
+                for r in reqs:
+                    item = r["PutRequest"]["Item"]
+                    self.items[self._key(table, item)] = item
+        return {"UnprocessedItems": {}}
+
+
+class FakeBedrock(_Latency):
+    """Canned Llama-style generations; streams them word by word."""
+
+    def __init__(self, latency_ms=0.0, reply="Thanks for asking! Our team at Hi Nature! Pet is happy to help."):
+        super().__init__(latency_ms)
+        self.reply = reply
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self._io()
+        return {"body": io.BytesIO(json.dumps({"generation": " " + self.reply, "stop_reason": "stop"}).encode())}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        self._io()
+        words = (" " + self.reply).split(" ")
+        return {"body": [{"chunk": {"bytes": json.dumps({"generation": (" " if i else "") + w}).encode()}}
+                         for i, w in enumerate(words)]}
+
+
+class FakeSNS(_Latency):
+    def __init__(self, latency_ms=0.0):
+        super().__init__(latency_ms)
+        self.messages = []
+
+    def publish(self, TopicArn, Message, Subject=None, **kwargs):
+        self._io()
+        self.messages.append(Message)
+        return {"MessageId": str(len(self.messages))}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self._io()
+        self.messages.extend(e["Message"] for e in PublishBatchRequestEntries)
+        return {"Successful": [{"Id": e["Id"]} for e in PublishBatchRequestEntries], "Failed": []}
+
+
+class FakeShopify(_Latency):
+    """ShopifyClient look-alike answering from the shopify_stub fixtures without HTTP."""
+
+    def get(self, path, params=None, deadline=None):
+        self._io()
+        params = params or {}
+        if path.endswith("customers/search.json"):
+            email = params.get("query", "").removeprefix("email:")
+            return {"customers": [c for c in CUSTOMERS if c["email"] == email]}
+        if path.endswith("orders.json"):
+            return {"orders": ORDERS.get(int(params.get("customer_id", 0)), [])}
+        return {}
+
+    def graphql(self, query, variables=None, deadline=None):
+        self._io()
+        email = (variables or {}).get("query", "").removeprefix("email:")
+        for c in CUSTOMERS:
+            if c["email"] == email:
+                latest = sorted(ORDERS.get(c["id"], []), key=lambda o: o["created_at"], reverse=True)[:1]
+                return {"customers": {"edges": [{"node": {
+                    "id": f"gid://shopify/Customer/{c['id']}",
+                    "orders": {"edges": [{"node": gql_order(o)} for o in latest]}}}]}}
+        return {"customers": {"edges": []}}
+
+
+def install(lf, latency_ms=0.0, **per_service_ms):
+    """Swap lambda_function's clients for fakes; per-service overrides: dynamo_ms=, bedrock_ms=, ..."""
+    def ms(name): return per_service_ms.get(f"{name}_ms", latency_ms)
+    fakes = {
+        "dynamo": FakeDynamo(ms("dynamo")),
+        "bedrock": FakeBedrock(ms("bedrock")),
+        "sns": FakeSNS(ms("sns")),
+        "shopify": FakeShopify(ms("shopify")),
+    }
+    for name, fake in fakes.items():
+        setattr(lf, name, fake)
+    return fakes
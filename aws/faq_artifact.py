@@ -0,0 +1,122 @@
+# faq_artifact.py
+"""Compiled FAQ bank: the FAQ items with their precomputed match index and keyword automaton.
+
+Layout (little endian):
+    b"HNFAQ" | u8 format | u32 header length | header JSON | section bytes ...
+The header holds the bank version, content hash, build time and each section's
+[offset, length, crc32]; sections are compact UTF-8 JSON. Artifact() memory-maps the file
+and decodes a section only when asked, so checking whether a file is newer reads the header.
+
+Build from the bank in lambda_function.py, or from a JSON list of {"q", "tags", "a"} items
+so answers can change without a code deploy:
+    python faq_artifact.py [--source faqs.json] [--out faq_bank.bin] [--version N]
+    aws s3 cp faq_bank.bin s3://<bucket>/faq_bank.bin    # picked up via FAQ_ARTIFACT_S3
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+
+MAGIC = b"HNFAQ"
+FORMAT = 1
+_HEAD = struct.Struct("<5sBI")
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def write(path, sections, **header):
+    """Write `sections` (name -> JSON-able) with `header`; readers never see a half-written file."""
+    blobs = {name: json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+             for name, obj in sections.items()}
+    table, offset = {}, 0
+    for name, blob in blobs.items():
+        table[name] = [offset, len(blob), zlib.crc32(blob)]
+        offset += len(blob)
+    head = json.dumps({**header, "sections": table}, ensure_ascii=False).encode("utf-8")
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEAD.pack(MAGIC, FORMAT, len(head)))
+        f.write(head)
+        for blob in blobs.values():
+            f.write(blob)
+    os.replace(tmp, path)
+
+
+class Artifact:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise ArtifactError(f"{path}: empty")
+        try:
+            magic, fmt, n = _HEAD.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise ArtifactError(f"{path}: not an FAQ artifact")
+            if fmt != FORMAT:
+                raise ArtifactError(f"{path}: format {fmt}, expected {FORMAT}")
+            self.header = json.loads(self._map[_HEAD.size:_HEAD.size + n])
+        except (struct.error, ValueError) as e:
+            self.close()
+            raise ArtifactError(f"{path}: unreadable header ({e})")
+        except ArtifactError:
+            self.close()
+            raise
+        self._base = _HEAD.size + n
+
+    @property
+    def version(self):
+        return self.header.get("version", 0)
+
+    def section(self, name):
+        offset, length, crc = self.header["sections"][name]
+        start = self._base + offset
+        blob = self._map[start:start + length]
+        if len(blob) != length or zlib.crc32(blob) != crc:
+            raise ArtifactError(f"section {name!r} is truncated or corrupt")
+        return json.loads(blob)
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build(out, source=None, version=None):
+    import lambda_function as lf
+
+    if source:
+        with open(source, encoding="utf-8") as f:
+            faqs = json.load(f)
+    else:
+        faqs = lf.FAQS
+    version = version or int(time.time())
+    write(out,
+          {"faqs": faqs,
+           "index": lf.build_faq_index(faqs),
+           "keywords": lf.build_keyword_automaton(faqs).to_state()},
+          version=version,
+          faq_hash=lf.faq_content_hash(faqs),
+          routes_hash=lf.routes_hash(),
+          built_at=datetime.now(timezone.utc).isoformat())
+    print(f"{len(faqs)} FAQs, version {version}, {os.path.getsize(out)} bytes -> {out}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--source", help="JSON list of FAQ items (default: FAQS in lambda_function.py)")
+    ap.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq_bank.bin"))
+    ap.add_argument("--version", type=int, help="bank version; containers only switch to a higher one "
+                                                "(default: current unix time)")
+    args = ap.parse_args()
+    build(args.out, args.source, args.version)
@@ -0,0 +1,77 @@
+# faq_tfidf.py
+"""Char n-gram TF-IDF scoring of the FAQ bank (needs numpy; imported lazily).
+
+Every question/tag string becomes one L2-normalized row of a dense TF-IDF matrix, so a
+batch of messages is scored with matrix products, CHUNK_ROWS messages at a time (the query
+matrix is dense: vocabulary-wide float32 rows), and then reduced to one score per FAQ with
+max-over-tags.
+
+Re-score a transcript dump (one message per line) when tuning FAQ_MATCH_THRESHOLD:
+    python faq_tfidf.py messages.txt > scores.tsv
+"""
+import math
+import sys
+from itertools import islice
+
+import numpy as np
+
+
+CHUNK_ROWS = 4096  # messages per matrix product: ~4096 x vocab x 4 bytes for the query matrix
+
+
+class TfidfFaqScorer:
+    def __init__(self, index, ngrams):
+        """`index` is lambda_function.build_faq_index(); `ngrams` is its char_ngrams()."""
+        self.ngrams = ngrams
+        postings = index["postings"]
+        n_strings = len(index["strings"])
+        self.vocab = {g: j for j, g in enumerate(sorted(postings))}
+        self.idf = np.array(
+            [math.log((1 + n_strings) / (1 + len(postings[g]))) + 1.0 for g in sorted(postings)],
+            dtype=np.float32,
+        )
+        m = np.zeros((n_strings, len(self.vocab)), dtype=np.float32)
+        for g, sids in postings.items():
+            j = self.vocab[g]
+            m[sids, j] = self.idf[j]
+        self.matrix = _l2_rows(m)
+        # spans are contiguous and non-empty (every FAQ has its question), so reduceat works
+        self.starts = np.array([a for a, _ in index["spans"]], dtype=np.intp)
+
+    def vectorize(self, texts):
+        q = np.zeros((len(texts), len(self.vocab)), dtype=np.float32)
+        for i, t in enumerate(texts):
+            cols = [self.vocab[g] for g in self.ngrams((t or "").lower().strip()) if g in self.vocab]
+            q[i, cols] = self.idf[cols]
+        return _l2_rows(q)
+
+    def item_scores(self, texts):
+        """(len(texts), n_faqs) cosine scores, max over each FAQ's question and tags. Dense in
+        len(texts): pass at most CHUNK_ROWS or so at a time."""
+        sims = self.vectorize(texts) @ self.matrix.T
+        return np.maximum.reduceat(sims, self.starts, axis=1)
+
+    def best(self, texts):
+        """[(score, faq_idx), ...]; ties go to the earlier FAQ like the linear scan."""
+        out = []
+        for at in range(0, len(texts), CHUNK_ROWS):
+            scores = self.item_scores(texts[at:at + CHUNK_ROWS])
+            idx = scores.argmax(axis=1)
+            out.extend((float(scores[i, j]), int(j)) for i, j in enumerate(idx))
+        return out
+
+
+def _l2_rows(m):
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+
+if __name__ == "__main__":
+    import lambda_function as lf
+
+    with open(sys.argv[1], encoding="utf-8") as f:
+        lines = (lf.normalize(line) for line in f if line.strip())
+        for messages in iter(lambda: list(islice(lines, CHUNK_ROWS)), []):
+            for msg, (score, item) in zip(messages, lf.best_faq_match_batch(messages, mode="tfidf")):
+                print(f"{score:.4f}\t{item['q'] if item else ''}\t{msg}")
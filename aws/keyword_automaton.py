@@ -0,0 +1,76 @@
+# keyword_automaton.py
+"""Aho-Corasick matcher over characters, for routing keywords and FAQ tags.
+
+Built once from (keyword, label) pairs; scan() walks the message a single time and returns
+every occurrence, overlapping ones included, with the same substring semantics as
+`keyword in message`. Works on code points, so English and CJK keywords mix freely:
+    ac = KeywordAutomaton([("order", "order_status"), ("到货", "delivery")])
+    ac.scan("我的order什么时候到货")  # [(2, "order", "order_status"), (11, "到货", "delivery")]
+Keywords are lowercased; scan() expects lowercased text.
+"""
+from collections import deque
+
+
+class KeywordAutomaton:
+    def __init__(self, pairs):
+        self._goto = [{}]
+        self._out = [()]
+        for keyword, label in dict.fromkeys((k.lower(), l) for k, l in pairs if k and k.strip()):
+            node = 0
+            for ch in keyword:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._out.append(())
+                node = nxt
+            self._out[node] += ((keyword, label),)
+        self._fail = [0] * len(self._goto)
+        self._link()
+
+    def _link(self):
+        """Failure links, breadth first; each node also inherits the outputs of its suffix node."""
+        goto, fail, out = self._goto, self._fail, self._out
+        q = deque(goto[0].values())
+        while q:
+            node = q.popleft()
+            for ch, child in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                nxt = goto[f].get(ch, 0)
+                fail[child] = nxt if nxt != child else 0
+                out[child] += out[fail[child]]
+                q.append(child)
+
+    def scan(self, text):
+        """[(start, keyword, label), ...] in order of where each occurrence ends."""
+        goto, fail, out = self._goto, self._fail, self._out
+        hits, node = [], 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for keyword, label in out[node]:
+                hits.append((i + 1 - len(keyword), keyword, label))
+        return hits
+
+    def to_state(self):
+        """JSON-friendly tables, so a prebuilt automaton can ship in an artifact."""
+        return {"goto": self._goto, "fail": self._fail, "out": self._out}
+
+    @classmethod
+    def from_state(cls, state):
+        """Inverse of to_state(); JSON turns tuple labels into lists, so they're turned back."""
+        self = cls.__new__(cls)
+        self._goto, self._fail = state["goto"], state["fail"]
+        self._out = [tuple((k, tuple(l) if isinstance(l, list) else l) for k, l in out)
+                     for out in state["out"]]
+        return self
+
+    def labels(self, text):
+        return {label for _, _, label in self.scan(text)}
+
+    def __len__(self):
+        return len(self._goto)
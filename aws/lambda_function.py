@@ -1,10 +1,14 @@
 # app.py
-import json, os, re, time, uuid, html
+import json, os, re, time, uuid, hashlib, threading, copy, contextvars, queue, random
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime, timezone
-from difflib import SequenceMatcher
-import urllib.request, urllib.parse
 
-import boto3
+from keyword_automaton import KeywordAutomaton
+from session_codec import encode_session, decode_session, encode_message, decode_message, pack, unpack
+
+# boto3, difflib, html, hmac/base64 and the Shopify client are imported on the code path
+# that needs them, so a cold start only pays for what its first turn uses.
 
 # =========================
 # Config
@@ -15,16 +19,160 @@ DDB_TABLE      = os.getenv("DDB_TABLE", "HN_Sessions")            # PK: session_
 SNS_TOPIC_ARN  = os.getenv("SNS_TOPIC_ARN", "")                   # optional
 BRAND_NAME     = "Hi Nature! Pet"
 
+# Escalation outbox: tickets are claimed in OUTBOX_TABLE (dedupe), then published to SNS by
+#   inline  -- on the request path, right after the claim (works with nothing else deployed)
+#   stream  -- outbox_stream_handler, subscribed to OUTBOX_TABLE's DynamoDB stream with
+#              OUTBOX_STREAM_FILTER; see "Escalation outbox" in the README before switching
+#   thread  -- a background thread; long-lived hosts only (server.py), Lambda freezes it
+OUTBOX_TABLE        = os.getenv("OUTBOX_TABLE", DDB_TABLE)        # "" keeps escalation dedupe in memory
+OUTBOX_FLUSH        = os.getenv("OUTBOX_FLUSH", "inline")         # inline | stream | thread
+if OUTBOX_FLUSH == "stream" and not OUTBOX_TABLE:
+    OUTBOX_FLUSH = "inline"   # no table, no stream: nothing would ever publish the tickets
+ESCALATION_DEDUPE_S = int(os.getenv("ESCALATION_DEDUPE_S", "900"))
+
+# Session storage: "blob" keeps the whole history JSON in one DDB_TABLE item per session;
+# "turns" stores one item per message in DDB_TURNS_TABLE and reads only the newest ones.
+SESSION_STORE           = os.getenv("SESSION_STORE", "blob")
+DDB_TURNS_TABLE         = os.getenv("DDB_TURNS_TABLE", "HN_SessionTurns")  # PK: session_id (S), SK: sk (S)
+SESSION_HISTORY_TURNS   = int(os.getenv("SESSION_HISTORY_TURNS", "10"))
+SESSION_CACHE_SIZE      = int(os.getenv("SESSION_CACHE_SIZE", "256"))       # warm-container cache; 0 disables
+SESSION_CACHE_TTL       = int(os.getenv("SESSION_CACHE_TTL", "300"))        # seconds
+SESSION_CONSISTENT_READ = os.getenv("SESSION_CONSISTENT_READ", "false").lower() == "true"
+SESSION_SAVE_ATTEMPTS   = int(os.getenv("SESSION_SAVE_ATTEMPTS", "5"))      # per turn, when other writers win the race
+# How sessions are written: "compact" (session_codec.py, binary + zlib) or "json" (readable by
+# deployments older than the codec). Both formats are always read.
+SESSION_CODEC           = os.getenv("SESSION_CODEC", "compact")
+
+# Request pipeline: session read, intent scoring and a speculative order lookup run concurrently
+# on a pool that survives across warm invocations. 0 runs every stage inline. A host running
+# many turns at once sizes it with size_pools() (server.py does, from --workers).
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "4"))
+# Bedrock calls the latency budget may abandon run on their own pool, so one still finishing
+# after its turn gave up on it never delays another turn's pipeline stages. 0 runs them inline.
+UPSTREAM_WORKERS = int(os.getenv("UPSTREAM_WORKERS", "8"))
+
+# Batch replay ({"batch": [...]}): sessions run concurrently on their own pool, each one's turns in order
+BATCH_WORKERS     = int(os.getenv("BATCH_WORKERS", "8"))
+BATCH_MAX_RECORDS = int(os.getenv("BATCH_MAX_RECORDS", "1000"))
+
+# Idempotent turns: a body "request_id" (or "turn" index) keys the turn's result for IDEMPOTENCY_TTL,
+# so a retried delivery gets the stored response instead of re-running Bedrock/Shopify/SNS.
+IDEMPOTENCY_TABLE   = os.getenv("IDEMPOTENCY_TABLE", DDB_TABLE)          # "" keeps results in this container only
+IDEMPOTENCY_TTL     = int(os.getenv("IDEMPOTENCY_TTL", "120"))           # seconds; 0 disables
+IDEMPOTENCY_LEASE_S = int(os.getenv("IDEMPOTENCY_LEASE_S", "15"))        # duplicates wait this long for the first;
+                                                                         # an older unfinished claim is presumed dead
+
 # Shopify
 SHOPIFY_STORE_URL   = os.getenv("SHOPIFY_STORE_URL", "https://yourstore.myshopify.com")
 SHOPIFY_ACCESS_TOKEN = os.getenv("SHOPIFY_ACCESS_TOKEN", "")
+SHOPIFY_DEADLINE    = float(os.getenv("SHOPIFY_DEADLINE", "3.0"))      # seconds per call, retries included
+SHOPIFY_MAX_RETRIES = int(os.getenv("SHOPIFY_MAX_RETRIES", "2"))
+SHOPIFY_ORDER_LOOKUP = os.getenv("SHOPIFY_ORDER_LOOKUP", "graphql")   # graphql (1 call) | rest (2 calls)
+SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET", "")       # signs orders/updated, fulfillments/create
+
+# Latest-order summaries: shared DynamoDB entry + short in-container copy
+ORDER_CACHE_TABLE     = os.getenv("ORDER_CACHE_TABLE", DDB_TABLE)
+ORDER_CACHE_TTL       = int(os.getenv("ORDER_CACHE_TTL", "900"))        # seconds, shared entry
+ORDER_CACHE_LOCAL_TTL = int(os.getenv("ORDER_CACHE_LOCAL_TTL", "30"))   # seconds, per container
+ORDER_CACHE_SIZE      = int(os.getenv("ORDER_CACHE_SIZE", "512"))
+
+# LLM prompt: history is packed newest-first into a token budget; older turns are folded into
+# a rolling summary kept in the session state.
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "600"))
+PROMPT_SUMMARY_TOKENS = int(os.getenv("PROMPT_SUMMARY_TOKENS", "150"))
+
+# First-turn (context-free) fallback replies, reused for the same or near-identical wording
+LLM_CACHE_SIZE       = int(os.getenv("LLM_CACHE_SIZE", "512"))          # 0 disables
+LLM_CACHE_TTL        = int(os.getenv("LLM_CACHE_TTL", "3600"))          # seconds
+LLM_CACHE_SIMILARITY = float(os.getenv("LLM_CACHE_SIMILARITY", "0.92")) # SequenceMatcher ratio for a near hit,
+                                                                        # which must also share its content words
+
+# Per-turn latency budget. A Bedrock call still running when it runs out is abandoned and the
+# reply degrades: an LLM fallback to the closest FAQ answer (or a holding message), a brand-tone
+# rewrite to the template text. Shopify calls get min(SHOPIFY_DEADLINE, what's left).
+TURN_BUDGET_MS         = int(os.getenv("TURN_BUDGET_MS", "8000"))        # 0 disables; body "budget_ms" can only lower it
+LLM_MIN_BUDGET_MS      = int(os.getenv("LLM_MIN_BUDGET_MS", "250"))      # don't start a Bedrock call with less left
+LAMBDA_MARGIN_MS       = int(os.getenv("LAMBDA_MARGIN_MS", "500"))       # kept back from the invocation's own timeout
+BEDROCK_READ_TIMEOUT   = float(os.getenv("BEDROCK_READ_TIMEOUT", "20"))  # seconds; bounds calls the budget abandoned
+DEGRADED_FAQ_MIN_SCORE = float(os.getenv("DEGRADED_FAQ_MIN_SCORE", "0.60"))  # below FAQ_MATCH_THRESHOLD on purpose
 
 # If True, FAQs will be paraphrased by brand_tone(); otherwise exact template is returned.
-USE_BRAND_TONE_FOR_FAQ = False
+# Rewrites are served from the artifact built by build_brand_tone.py, falling back to Bedrock on a miss.
+USE_BRAND_TONE_FOR_FAQ = os.getenv("USE_BRAND_TONE_FOR_FAQ", "false").lower() == "true"
+BRAND_TONE_CACHE_PATH  = os.getenv("BRAND_TONE_CACHE_PATH",
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), "brand_tone_cache.json"))
+
+# FAQ matching: "index" narrows to the top-K FAQs by n-gram overlap before exact scoring;
+# "exact" scores every FAQ and returns the same (score, item) as the original linear scan;
+# "tfidf" scores with char n-gram TF-IDF cosine (needs numpy, see faq_tfidf.py).
+FAQ_MATCH_MODE      = os.getenv("FAQ_MATCH_MODE", "index")
+FAQ_INDEX_TOP_K     = int(os.getenv("FAQ_INDEX_TOP_K", "5"))
+FAQ_MATCH_THRESHOLD = float(os.getenv("FAQ_MATCH_THRESHOLD", "0.70"))
+FAQ_CACHE_SIZE      = int(os.getenv("FAQ_CACHE_SIZE", "1024"))          # 0 disables
+
+# Compiled FAQ bank (faq_artifact.py): loaded on first use with its prebuilt index, falling back
+# to the FAQS literal below. A higher version at FAQ_ARTIFACT_PATH (or FAQ_ARTIFACT_S3, fetched
+# to /tmp) is picked up within FAQ_ARTIFACT_CHECK_S seconds, between turns.
+FAQ_ARTIFACT_PATH    = os.getenv("FAQ_ARTIFACT_PATH",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq_bank.bin"))
+FAQ_ARTIFACT_S3      = os.getenv("FAQ_ARTIFACT_S3", "")                 # s3://bucket/key
+FAQ_ARTIFACT_CHECK_S = int(os.getenv("FAQ_ARTIFACT_CHECK_S", "60"))      # 0: load once, never re-check
+
+# FAQ bundle for the widget (GET FAQ_BUNDLE_PATH): answers + match strings, ETag'd by content.
+# chatbot.js answers hits scoring FAQ_CLIENT_THRESHOLD (char n-gram Dice) itself and reports them
+# in "faq_log" batches, so sessions still record those turns.
+FAQ_BUNDLE_PATH        = os.getenv("FAQ_BUNDLE_PATH", "/faq-bundle")
+FAQ_BUNDLE_MAX_AGE     = int(os.getenv("FAQ_BUNDLE_MAX_AGE", "3600"))      # browsers
+FAQ_BUNDLE_CDN_MAX_AGE = int(os.getenv("FAQ_BUNDLE_CDN_MAX_AGE", "86400")) # CloudFront (s-maxage)
+FAQ_CLIENT_THRESHOLD   = float(os.getenv("FAQ_CLIENT_THRESHOLD", "0.85"))  # 0 turns local answers off
+FAQ_LOG_MAX_RECORDS    = int(os.getenv("FAQ_LOG_MAX_RECORDS", "50"))
+
+# Per-turn timing spans, logged as CloudWatch Embedded Metric Format; DEBUG_TIMINGS also echoes
+# them in the response "meta". With both off, spans cost one ContextVar lookup.
+METRICS_EMF       = os.getenv("METRICS_EMF", "true").lower() == "true"
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "HiNaturePetChatbot")
+DEBUG_TIMINGS     = os.getenv("DEBUG_TIMINGS", "false").lower() == "true"
+
+_INIT_LOCK = threading.Lock()  # boto3's default session isn't safe to build clients on concurrently
+
+class Lazy:
+    """Builds its target on first attribute access; the warm container keeps it afterwards."""
+    def __init__(self, factory):
+        self._factory, self._obj = factory, None
+
+    def get(self):
+        if self._obj is None:
+            with _INIT_LOCK:
+                if self._obj is None:
+                    self._obj = self._factory()
+        return self._obj
+
+    @property
+    def ready(self): return self._obj is not None
 
-bedrock = boto3.client("bedrock-runtime", region_name=BEDROCK_REGION)
-dynamo  = boto3.client("dynamodb")
-sns     = boto3.client("sns")
+    def __getattr__(self, name): return getattr(self.get(), name)
+
+def _boto3_client(service, **kwargs):
+    import boto3
+    return boto3.client(service, **kwargs)
+
+def _shopify_client():
+    from shopify_client import ShopifyClient
+    return ShopifyClient(SHOPIFY_STORE_URL, SHOPIFY_ACCESS_TOKEN,
+                         deadline=SHOPIFY_DEADLINE, max_retries=SHOPIFY_MAX_RETRIES)
+
+def _bedrock_client():
+    from botocore.config import Config
+    return _boto3_client("bedrock-runtime", region_name=BEDROCK_REGION,
+                         config=Config(connect_timeout=2, read_timeout=BEDROCK_READ_TIMEOUT,
+                                       retries={"max_attempts": 2}))
+
+bedrock = Lazy(_bedrock_client)
+dynamo  = Lazy(lambda: _boto3_client("dynamodb"))
+sns     = Lazy(lambda: _boto3_client("sns"))
+s3      = Lazy(lambda: _boto3_client("s3"))
+shopify = Lazy(_shopify_client)
+CLIENTS = {"bedrock": bedrock, "dynamodb": dynamo, "sns": sns, "s3": s3, "shopify": shopify}
 
 # =========================
 # FAQ BANK (template answers only)
@@ -396,62 +544,742 @@ def _resp(code, obj):
 
 def now_epoch(): return int(time.time())
 def normalize(s): return re.sub(r"\s+", " ", s or "").strip()
-def sm_ratio(a, b): return SequenceMatcher(None, a.lower().strip(), b.lower().strip()).ratio()
+def sm_ratio(a, b):
+    from difflib import SequenceMatcher
+    return SequenceMatcher(None, a.lower().strip(), b.lower().strip()).ratio()
+
+_MISS = object()
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU with optional TTL and hit/miss/eviction counters (per warm container)."""
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=_MISS):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self._data[key]
+                self.evictions += 1
+                entry = None
+            if entry is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0: return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def __len__(self): return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+# =========================
+# Metrics (CloudWatch EMF)
+# =========================
+_TURN = contextvars.ContextVar("turn_metrics", default=None)
+
+class TurnMetrics:
+    """Span timings (ms, one value per call) and first cache outcome per cache, for one turn."""
+    def __init__(self):
+        self.spans, self.cache = {}, {}
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+
+    def add(self, name, ms):
+        with self._lock:
+            self.spans.setdefault(name, []).append(round(ms, 3))
+
+    def elapsed_ms(self): return round((time.perf_counter() - self._t0) * 1000, 3)
+
+class span:
+    """`with span("shopify"):` times the block into the current turn's metrics, if any."""
+    __slots__ = ("name", "m", "t")
+    def __init__(self, name):
+        self.name, self.m = name, _TURN.get()
+
+    def __enter__(self):
+        if self.m is not None: self.t = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.m is not None: self.m.add(self.name, (time.perf_counter() - self.t) * 1000)
+
+def note_cache(name, hit):
+    m = _TURN.get()
+    if m is not None: m.cache.setdefault(name, hit)
+
+def emit_emf(metrics, dimensions, dimension_sets=None, counts=None, properties=None):
+    """Log one EMF record. metrics: name -> ms (or a list of ms); counts: name -> count."""
+    counts = counts or {}
+    print(json.dumps({
+        "_aws": {"Timestamp": int(time.time() * 1000), "CloudWatchMetrics": [{
+            "Namespace": METRICS_NAMESPACE,
+            "Dimensions": dimension_sets or [list(dimensions)],
+            "Metrics": [{"Name": n, "Unit": "Milliseconds"} for n in metrics] +
+                       [{"Name": n, "Unit": "Count"} for n in counts],
+        }]},
+        **(properties or {}), **dimensions, **metrics, **counts,
+    }, ensure_ascii=False))
+
+# the cache that decides each intent's cost, reported as the CacheHit dimension
+_INTENT_CACHE = {"faq": "intent", "order_status": "order", "fallback": "llm"}
+
+def emit_turn_metrics(m, response):
+    intent = response.get("intent") or "none"
+    hit = m.cache.get(_INTENT_CACHE.get(intent))
+    degraded = response.get("meta", {}).get("degraded") or []
+    emit_emf({**{n: v[0] if len(v) == 1 else v for n, v in m.spans.items()}, "turn": m.elapsed_ms()},
+             {"Intent": intent, "CacheHit": "none" if hit is None else str(hit).lower()},
+             dimension_sets=[["Intent"], ["Intent", "CacheHit"]],
+             counts={"degraded": int(bool(degraded))},  # averages to the degradation rate
+             properties={"session_id": response.get("session_id"),
+                         "cache": dict(m.cache), "degraded_stages": degraded,
+                         "caches": cache_stats()})  # container totals, for Logs Insights
+
+def turn_timings(m):
+    return {"spans_ms": {n: round(sum(v), 3) for n, v in m.spans.items()},
+            "calls": {n: len(v) for n, v in m.spans.items() if len(v) > 1},
+            "cache": dict(m.cache), "turn_ms": m.elapsed_ms()}
+
+_POOL = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="turn") if PIPELINE_WORKERS > 0 else None
+
+_UPSTREAM = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix="upstream") if UPSTREAM_WORKERS > 0 else None
+
+def size_pools(concurrency):
+    """Size the shared pools for `concurrency` turns in flight at once: each holds up to two
+    pipeline tasks (session read + order prefetch, later the save) and two upstream calls (one
+    it may have abandoned). A pool configured to 0 (inline) stays that way."""
+    global _POOL, PIPELINE_WORKERS, _UPSTREAM, UPSTREAM_WORKERS
+    workers = max(PIPELINE_WORKERS, 2 * concurrency)
+    if _POOL is not None and workers != PIPELINE_WORKERS:
+        old, PIPELINE_WORKERS = _POOL, workers
+        _POOL = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="turn")
+        old.shutdown(wait=False)  # queued and running tasks still finish
+    workers = max(UPSTREAM_WORKERS, 2 * concurrency)
+    if _UPSTREAM is not None and workers != UPSTREAM_WORKERS:
+        old, UPSTREAM_WORKERS = _UPSTREAM, workers
+        _UPSTREAM = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upstream")
+        old.shutdown(wait=False)
+
+def submit(fn, *args, **kwargs):
+    """Run fn on the shared pool (inline when PIPELINE_WORKERS=0); returns a Future.
+    Only for leaf I/O work -- a pooled task waiting on another pooled task can starve the pool.
+    The task runs in a copy of the caller's context, so its spans land in the caller's turn."""
+    if _POOL is not None:
+        return _POOL.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    f = Future()
+    try:
+        f.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        f.set_exception(e)
+    return f
+
+# =========================
+# Latency budget
+# =========================
+class DeadlineExceeded(Exception):
+    """The turn's latency budget ran out before the call finished."""
+
+class Budget:
+    """Monotonic deadline for one turn plus the degradations it caused ({"stage", "fallback"})."""
+    __slots__ = ("ms", "expires", "degraded")
+    def __init__(self, ms, cap=None):
+        self.ms = ms
+        self.expires = time.monotonic() + ms / 1000 if ms > 0 else None
+        if cap is not None:
+            self.expires = cap if self.expires is None else min(self.expires, cap)
+        self.degraded = []
+
+    def remaining(self):
+        """Seconds left, or None when the turn is unbounded."""
+        return None if self.expires is None else max(0.0, self.expires - time.monotonic())
+
+_BUDGET = contextvars.ContextVar("turn_budget", default=None)
+_INVOKE_DEADLINE = contextvars.ContextVar("invoke_deadline", default=None)  # set from the Lambda context
+
+def turn_budget_ms(body):
+    asked = body.get("budget_ms")
+    if isinstance(asked, (int, float)) and asked > 0:
+        return min(asked, TURN_BUDGET_MS) if TURN_BUDGET_MS > 0 else asked
+    return TURN_BUDGET_MS
+
+def remaining_budget():
+    b = _BUDGET.get()
+    return None if b is None else b.remaining()
+
+def note_degraded(stage, fallback):
+    b = _BUDGET.get()
+    if b is not None: b.degraded.append({"stage": stage, "fallback": fallback})
+
+def result_within_budget(f):
+    """f.result(), or DeadlineExceeded once the turn's budget is spent (f keeps running)."""
+    try:
+        return f.result(timeout=remaining_budget())
+    except FutureTimeout:
+        raise DeadlineExceeded() from None
+
+def _submit_upstream(fn, *args):
+    return _UPSTREAM.submit(contextvars.copy_context().run, fn, *args)
+
+def within_budget(fn, *args, min_s=0.0):
+    """fn(*args), or DeadlineExceeded once the turn's budget is spent. The call runs on the
+    upstream pool so we can stop waiting for it; the abandoned call finishes (or times out) there.
+    With UPSTREAM_WORKERS=0 it runs inline and the budget is only checked before starting."""
+    left = remaining_budget()
+    if left is not None and left <= min_s:
+        raise DeadlineExceeded()
+    if left is None or _UPSTREAM is None:
+        return fn(*args)
+    f = _submit_upstream(fn, *args)
+    try:
+        return result_within_budget(f)
+    except DeadlineExceeded:
+        f.cancel()
+        raise
+
+def iter_within_budget(iterable):
+    """Yield from `iterable` (a blocking stream) until the turn's budget runs out, then raise
+    DeadlineExceeded. Items are read ahead on the upstream pool; the caller closes the stream."""
+    if remaining_budget() is None or _UPSTREAM is None:
+        yield from iterable
+        return
+    q = queue.SimpleQueue()
+    def pump():
+        try:
+            for x in iterable: q.put((True, x))
+            q.put((False, None))
+        except Exception as e:
+            q.put((False, e))
+    _submit_upstream(pump)
+    while True:
+        try:
+            more, x = q.get(timeout=remaining_budget())
+        except queue.Empty:
+            raise DeadlineExceeded() from None
+        if not more:
+            if x is not None: raise x
+            return
+        yield x
+
+# =========================
+# FAQ matching index (built or loaded once, on first use)
+# =========================
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
 
-def best_faq_match(text):
+def _latin_grams(s):
+    s = s.strip()
+    if not s: return set()
+    s = f" {s} "
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+def char_ngrams(s):
+    """Char trigrams for Latin runs; unigrams + bigrams for CJK runs (no spaces between words)."""
+    grams, pos = set(), 0
+    for m in _CJK_RE.finditer(s):
+        grams |= _latin_grams(s[pos:m.start()])
+        run = m.group(0)
+        grams.update(run)
+        grams.update(run[i:i+2] for i in range(len(run) - 1))
+        pos = m.end()
+    grams |= _latin_grams(s[pos:])
+    return grams
+
+def build_faq_index(faqs):
+    """Lowercased question/tag strings per FAQ plus an inverted n-gram -> string-id map."""
+    strings, spans, sizes, postings = [], [], [], {}
+    for item in faqs:
+        start = len(strings)
+        for s in [item["q"]] + item.get("tags", []):
+            s = s.lower().strip()
+            sid = len(strings)
+            strings.append(s)
+            grams = char_ngrams(s)
+            sizes.append(len(grams))
+            for g in grams:
+                postings.setdefault(g, []).append(sid)
+        spans.append((start, len(strings)))
+    owner = [i for i, (a, b) in enumerate(spans) for _ in range(a, b)]
+    return {"strings": strings, "spans": spans, "sizes": sizes, "owner": owner, "postings": postings}
+
+def faq_content_hash(faqs):
+    return hashlib.sha1(json.dumps(faqs, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+class FaqBank:
+    """The FAQ items with everything derived from them: match index, keyword automaton, content
+    hash and artifact version (0 for the FAQS literal). Not modified once built; reload_faqs()
+    publishes a new bank with one assignment, and readers take one snapshot (ensure_faqs()) per
+    call, so a swap never mixes one bank's index with another's items."""
+    __slots__ = ("faqs", "index", "keywords", "hash", "version", "_tfidf")
+
+    def __init__(self, faqs, index=None, keywords=None, faq_hash=None, version=0):
+        self.faqs = faqs
+        self.index = index or build_faq_index(faqs)
+        self.keywords = keywords or build_keyword_automaton(faqs)
+        self.hash = faq_hash or faq_content_hash(faqs)
+        self.version = version
+        self._tfidf = None
+
+    def tfidf(self):
+        if self._tfidf is None:  # a racing first call builds it twice; both results are equal
+            from faq_tfidf import TfidfFaqScorer
+            self._tfidf = TfidfFaqScorer(self.index, char_ngrams)
+        return self._tfidf
+
+_BANK = None  # the installed FaqBank; set by ensure_faqs()
+
+def reload_faqs(faqs, index=None, keywords=None, faq_hash=None, version=0):
+    """Build and install a new FAQ bank; cached matches follow its hash. An artifact passes its
+    prebuilt index/keywords/hash; anything missing is built here."""
+    global _BANK
+    bank = FaqBank(faqs, index, keywords, faq_hash, version)
+    for k, v in load_brand_tone_cache(faqs=faqs).items():  # rewrites of answers the old bank didn't have
+        BRAND_TONE_CACHE.setdefault(k, v)
+    _BANK = bank
+    prune_brand_tone_cache(bank)
+    return bank
+
+_FAQ_LOCK = threading.Lock()
+_faq_pending = None   # newer bank parsed off the request path, installed by the next ensure_faqs()
+_faq_seen = None      # (mtime_ns, size) or S3 ETag of the artifact last looked at
+_faq_checked = 0.0
+
+def ensure_faqs():
+    """The installed FaqBank. On first use that's the artifact (else the literal); later, any
+    newer artifact that refresh_faq_artifact() has staged is installed first."""
+    global _faq_pending
+    bank = _BANK
+    if bank is not None and _faq_pending is None: return bank
+    with _FAQ_LOCK:
+        if _BANK is None:
+            staged = read_faq_artifact(FAQ_ARTIFACT_PATH)
+            if staged: _install_faqs(staged)
+            else: reload_faqs(FAQS)
+        if _faq_pending is not None:
+            staged, _faq_pending = _faq_pending, None
+            if staged["version"] > _BANK.version: _install_faqs(staged)
+        return _BANK
+
+def read_faq_artifact(path, newer_than=None):
+    """The bank in a compiled artifact, or None if it's missing, unreadable or not newer."""
+    from faq_artifact import Artifact, ArtifactError
+    try:
+        with Artifact(path) as art:
+            if newer_than is not None and art.version <= newer_than:
+                return None
+            bank = {"version": art.version, "faq_hash": art.header["faq_hash"],
+                    "faqs": art.section("faqs"), "index": art.section("index")}
+            if art.header.get("routes_hash") == routes_hash():  # else rebuilt from the current KW_* lists
+                bank["keywords"] = KeywordAutomaton.from_state(art.section("keywords"))
+            return bank
+    except (OSError, KeyError, ValueError, ArtifactError):
+        return None
+
+def _install_faqs(staged):
+    reload_faqs(staged["faqs"], index=staged["index"], keywords=staged.get("keywords"),
+                faq_hash=staged["faq_hash"], version=staged["version"])
+
+def refresh_faq_artifact():
+    """Every FAQ_ARTIFACT_CHECK_S, look for a newer artifact on the pool without waiting for it."""
+    global _faq_checked
+    if not FAQ_ARTIFACT_CHECK_S or time.monotonic() - _faq_checked < FAQ_ARTIFACT_CHECK_S: return
+    _faq_checked = time.monotonic()
+    submit(_check_faq_artifact)
+
+def _check_faq_artifact():
+    global _faq_pending, _faq_seen
+    try:
+        if FAQ_ARTIFACT_S3:
+            bucket, _, key = FAQ_ARTIFACT_S3.removeprefix("s3://").partition("/")
+            seen = s3.head_object(Bucket=bucket, Key=key)["ETag"]
+            if seen == _faq_seen: return
+            etag = seen.strip('"')
+            path = f"/tmp/faq_bank.{etag}.bin"
+            with open(path, "wb") as f:
+                f.write(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+        else:
+            path = FAQ_ARTIFACT_PATH
+            st = os.stat(path)
+            seen = (st.st_mtime_ns, st.st_size)
+            if seen == _faq_seen: return
+        bank = read_faq_artifact(path, newer_than=_BANK.version if _BANK else 0)
+        if FAQ_ARTIFACT_S3: os.remove(path)  # fully parsed; the map is closed
+        _faq_seen = seen
+        if bank: _faq_pending = bank
+    except Exception:
+        pass  # keep serving the installed bank; the next check tries again
+
+def faq_candidates(bank, text_l, k=None):
+    """Indexes of the top-k FAQs by n-gram Dice overlap with the query, in bank order."""
+    k = k or FAQ_INDEX_TOP_K
+    grams = char_ngrams(text_l)
+    if not grams:
+        return range(len(bank.index["spans"]))
+    shared = {}
+    postings = bank.index["postings"]
+    for g in grams:
+        for sid in postings.get(g, ()):
+            shared[sid] = shared.get(sid, 0) + 1
+    sizes, owner = bank.index["sizes"], bank.index["owner"]
+    per_item = {}
+    for sid, n in shared.items():
+        dice = 2.0 * n / (len(grams) + sizes[sid])
+        idx = owner[sid]
+        if dice > per_item.get(idx, 0.0):
+            per_item[idx] = dice
+    top = sorted(per_item, key=per_item.get, reverse=True)[:k]
+    return sorted(top)
+
+def _item_score(bank, text_l, idx, floor):
+    """Max SequenceMatcher ratio over one FAQ's strings.
+
+    Strings whose quick upper bounds can't beat `floor` are skipped; they could not
+    change the result of best_faq_match, so the answer is identical to a full scan.
+    """
+    from difflib import SequenceMatcher
+    start, end = bank.index["spans"][idx]
+    strings = bank.index["strings"]
+    sm = SequenceMatcher(None, text_l, "")
+    score = 0.0
+    for sid in range(start, end):
+        sm.set_seq2(strings[sid])
+        bar = max(floor, score)
+        if sm.real_quick_ratio() <= bar or sm.quick_ratio() <= bar:
+            continue
+        score = max(score, sm.ratio())
+    return score
+
+# Match/intent results keyed on the bank's hash and the normalized, lowercased message; entries
+# for a replaced bank can't be hit and age out of the LRU.
+FAQ_CACHE = LRUCache(FAQ_CACHE_SIZE)
+
+def _faq_cache_key(kind, text, mode, bank):
+    return (kind, mode, bank.hash, normalize(text).lower())
+
+def faq_cache_stats(): return {**FAQ_CACHE.stats(), "faq_version": _BANK.version if _BANK else 0}
+
+def best_faq_match(text, mode=None, hits=None, bank=None):
+    """`hits` is bank.keywords.scan() of the message, if the caller already ran it; pass the
+    `bank` it came from so both refer to the same FAQ indexes."""
+    bank = bank or ensure_faqs()
+    mode = mode or FAQ_MATCH_MODE
+    key = _faq_cache_key("match", text, mode, bank)
+    with span("best_faq_match"):
+        best = FAQ_CACHE.get(key)
+        note_cache("faq_match", best is not _MISS)
+        if best is _MISS:
+            best = _tfidf_batch(bank, [key[3]])[0] if mode == "tfidf" else _scan_faqs(bank, key[3], mode, hits)
+            FAQ_CACHE.put(key, best)
+    return best  # (score, item)
+
+def _scan_faqs(bank, text_l, mode, hits=None):
+    if mode == "exact":
+        cands = range(len(bank.faqs))
+    else:
+        # FAQs with a tag inside the message are scored even if the n-gram overlap missed them
+        tagged = {label[1] for _, _, label in (bank.keywords.scan(text_l) if hits is None else hits)
+                  if label[0] == "faq"}
+        cands = sorted(tagged.union(faq_candidates(bank, text_l)))
     best = (0.0, None)
-    for item in FAQS:
-        score = sm_ratio(text, item["q"])
-        for tag in item.get("tags", []):
-            score = max(score, sm_ratio(text, tag))
+    for idx in cands:
+        score = _item_score(bank, text_l, idx, best[0])
         if score > best[0]:
-            best = (score, item)
-    return best  # (score, item)
+            best = (score, bank.faqs[idx])
+    return best
+
+def _tfidf_batch(bank, texts):
+    return [(score, bank.faqs[idx] if score > 0 else None)
+            for score, idx in bank.tfidf().best(list(texts))]
+
+def best_faq_match_batch(texts, mode=None):
+    """best_faq_match over many messages; "tfidf" scores them faq_tfidf.CHUNK_ROWS at a time."""
+    mode = mode or FAQ_MATCH_MODE
+    bank = ensure_faqs()
+    if mode != "tfidf":
+        return [best_faq_match(t, mode, bank=bank) for t in texts]
+    return _tfidf_batch(bank, [normalize(t).lower() for t in texts])
 
 # DynamoDB session state
-def load_session(session_id):
+# Sessions carry a "version" that save_session bumps with a conditional write. Saved sessions are
+# kept in a per-container write-through cache; a warm container serves the next turn of the same
+# chat from memory once a consistent read of the version alone shows nobody (another container,
+# the widget's faq_log beacon) saved since, so a turn is never computed on stale history. Misses
+# use eventually consistent reads unless SESSION_CONSISTENT_READ.
+class StaleSessionError(Exception):
+    """Another writer saved the session after we read it."""
+
+SESSION_CACHE = LRUCache(SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+
+def _empty_session(): return {"history": [], "state": {}, "version": 0, "turns": 0}
+
+# Order-cache, outbox and idempotency items share the sessions' key space (the tables default
+# to DDB_TABLE), so a client-chosen session_id may not take one of their prefixes.
+RESERVED_KEY_PREFIXES = ("order#", "esc#", "idem#")
+
+def valid_session_id(session_id): return not session_id.startswith(RESERVED_KEY_PREFIXES)
+
+# Set by a non-persisting batch: sessions live in this dict and nothing is written to AWS.
+_SCRATCH = contextvars.ContextVar("scratch_sessions", default=None)
+
+def _error_code(e): return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+def _version_condition(version):
+    if not version:
+        return {"ConditionExpression": "attribute_not_exists(#v)", "ExpressionAttributeNames": {"#v": "version"}}
+    return {"ConditionExpression": "#v = :v", "ExpressionAttributeNames": {"#v": "version"},
+            "ExpressionAttributeValues": {":v": {"N": str(version)}}}
+
+def stored_version(session_id):
+    """The session's saved version from a consistent read of that attribute alone (None on error)."""
+    if SESSION_STORE == "turns":
+        table, key = DDB_TURNS_TABLE, {"session_id": {"S": session_id}, "sk": {"S": HEAD_SK}}
+    else:
+        table, key = DDB_TABLE, {"session_id": {"S": session_id}}
+    try:
+        r = dynamo.get_item(TableName=table, Key=key, ConsistentRead=True,
+                            ProjectionExpression="#v", ExpressionAttributeNames={"#v": "version"})
+    except Exception:
+        return None
+    return int(r.get("Item", {}).get("version", {"N": "0"})["N"])
+
+def load_session(session_id, consistent=None):
+    """consistent=None: serve from the warm cache if it's still the saved version, else an
+    eventually consistent read (by default)."""
+    with span("load_session"):
+        scratch = _SCRATCH.get()
+        if scratch is not None:
+            return copy.deepcopy(scratch.get(session_id) or _empty_session())
+        if consistent is None:
+            cached = SESSION_CACHE.get(session_id)
+            if cached is not _MISS and stored_version(session_id) != cached["version"]:
+                SESSION_CACHE.pop(session_id)
+                cached, consistent = _MISS, True  # someone saved since: read what they wrote
+            note_cache("session", cached is not _MISS)
+            if cached is not _MISS:
+                return copy.deepcopy(cached)
+            consistent = consistent or SESSION_CONSISTENT_READ
+        if SESSION_STORE == "turns":
+            return load_session_turns(session_id, consistent=consistent)
+        return load_session_blob(session_id, consistent=consistent)
+
+def save_session(session_id, history, state, version=None, turns=None):
+    """Write the session; with `version`, only if nobody else saved since. Returns the new version.
+    `turns` is the per-turn store's message counter as read with `version`."""
+    scratch = _SCRATCH.get()
+    if scratch is not None:
+        scratch[session_id] = copy.deepcopy({"history": history, "state": state, "version": (version or 0) + 1})
+        return scratch[session_id]["version"]
+    try:
+        with span("save_session"):
+            if SESSION_STORE == "turns":
+                new_version, turns = save_session_turns(session_id, history, state, version, turns)
+            else:
+                new_version = save_session_blob(session_id, history, state, version)
+    except Exception as e:
+        if _error_code(e) == "ConditionalCheckFailedException":
+            SESSION_CACHE.pop(session_id)
+            raise StaleSessionError(session_id) from e
+        raise
+    keep = history[-SESSION_HISTORY_TURNS:] if SESSION_STORE == "turns" else history
+    SESSION_CACHE.put(session_id, copy.deepcopy({"history": keep, "state": state, "version": new_version,
+                                                 "turns": turns or 0}))
+    return new_version
+
+def commit_session(session_id, session, loaded):
+    """Save a turn on the version it was read at. While another writer gets there first, re-read
+    consistently and replay this turn's messages (history[loaded:]) on top, up to
+    SESSION_SAVE_ATTEMPTS saves in all, with a short jittered pause between them. Every save first
+    folds what has left the prompt window into the summary (budget_history)."""
+    mine = session["history"][loaded:]
+    history, state, version, turns = session["history"], session["state"], session["version"], session.get("turns")
+    for attempt in range(1, SESSION_SAVE_ATTEMPTS + 1):
+        budget_history(history, state)
+        try:
+            return save_session(session_id, history, state, version, turns)
+        except StaleSessionError:
+            if attempt >= SESSION_SAVE_ATTEMPTS: raise
+        time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+        fresh = load_session(session_id, consistent=True)
+        history = fresh["history"] + mine
+        # keep the winner's summary (it covers what it saved); the next pass folds on from there
+        state = {**fresh["state"], **{k: v for k, v in session["state"].items()
+                                      if k not in ("summary", "summary_upto")}}
+        version, turns = fresh["version"], fresh.get("turns")
+
+def load_session_blob(session_id, consistent=True):
     try:
         r = dynamo.get_item(
             TableName=DDB_TABLE,
             Key={"session_id": {"S": session_id}},
-            ConsistentRead=True
+            ConsistentRead=consistent
         )
         if "Item" not in r:
-            return {"history": [], "state": {}}
+            return _empty_session()
         item = r["Item"]
-        history = json.loads(item.get("history", {"S": "[]"})["S"])
-        state   = json.loads(item.get("state",   {"S": "{}"})["S"])
-        return {"history": history, "state": state}
+        if "data" in item:
+            history, state = decode_session(item["data"]["B"])
+        else:
+            history = json.loads(item.get("history", {"S": "[]"})["S"])
+            state   = json.loads(item.get("state",   {"S": "{}"})["S"])
+        version = int(item.get("version", {"N": "0"})["N"])
+        return {"history": history, "state": state, "version": version}
     except Exception:
-        return {"history": [], "state": {}}
+        return _empty_session()
 
-def save_session(session_id, history, state):
+def save_session_blob(session_id, history, state, version=None):
+    new_version = (version or 0) + 1
+    if SESSION_CODEC == "compact":
+        body = {"data": {"B": encode_session(history, state)}}
+    else:
+        body = {"history": {"S": json.dumps(history, ensure_ascii=False)},
+                "state":   {"S": json.dumps(state, ensure_ascii=False)}}
     dynamo.put_item(
         TableName=DDB_TABLE,
         Item={
             "session_id": {"S": session_id},
-            "history": {"S": json.dumps(history, ensure_ascii=False)},
-            "state":   {"S": json.dumps(state, ensure_ascii=False)},
+            **body,
+            "version": {"N": str(new_version)},
+            "updated_at": {"N": str(now_epoch())}
+        },
+        **(_version_condition(version) if version is not None else {})
+    )
+    return new_version
+
+# Per-turn layout: one item per message under sk "turn#0000000001", ..., plus a "~head" item
+# with the session state and version. "~" sorts after "turn#", so one descending Query returns
+# the head followed by the newest turns. Loaded messages carry their "turn" number; save only
+# writes messages without one, numbered on from the head's "turns" counter as read with its
+# version (a writer that lost the head race re-reads it, so two writers never pick the same
+# numbers even when the winner's turn items aren't visible yet). Sessions still in the blob
+# table are migrated on their first save.
+# With SESSION_CODEC=compact a turn is one binary "m" attribute and the head's state is binary.
+HEAD_SK = "~head"
+
+def _state_attr(state):
+    if SESSION_CODEC == "compact": return {"B": pack(state)}
+    return {"S": json.dumps(state, ensure_ascii=False)}
+
+def _state_from_attr(attr):
+    return unpack(attr["B"]) if "B" in attr else json.loads(attr["S"])
+
+def _turn_item(session_id, m, turn):
+    item = {
+        "session_id": {"S": session_id},
+        "sk":      {"S": f"turn#{turn:010d}"},
+    }
+    if SESSION_CODEC == "compact":
+        item["m"] = {"B": encode_message({**m, "ts": m.get("ts", now_epoch())})}
+        return item
+    item.update({
+        "role":    {"S": m["role"]},
+        "content": {"S": m["content"]},
+        "ts":      {"N": str(m.get("ts", now_epoch()))},
+    })
+    if m.get("intent"): item["intent"] = {"S": m["intent"]}
+    return item
+
+def _turn_from_item(item):
+    turn = int(item["sk"]["S"].split("#", 1)[1])
+    if "m" in item:
+        return {**decode_message(item["m"]["B"]), "turn": turn}
+    m = {"role": item["role"]["S"], "content": item["content"]["S"],
+         "ts": int(item["ts"]["N"]), "turn": turn}
+    if "intent" in item: m["intent"] = item["intent"]["S"]
+    return m
+
+def load_session_turns(session_id, limit=None, consistent=True):
+    limit = limit or SESSION_HISTORY_TURNS
+    try:
+        r = dynamo.query(
+            TableName=DDB_TURNS_TABLE,
+            KeyConditionExpression="session_id = :s",
+            ExpressionAttributeValues={":s": {"S": session_id}},
+            ScanIndexForward=False, Limit=limit + 1, ConsistentRead=consistent
+        )
+        items = r.get("Items", [])
+        if not items:
+            # not migrated yet (or brand new): the head doesn't exist, so write at version 0
+            return {**load_session_blob(session_id, consistent=consistent), "version": 0}
+        head = items[0] if items[0]["sk"]["S"] == HEAD_SK else None
+        turns = [_turn_from_item(i) for i in reversed(items) if i["sk"]["S"] != HEAD_SK]
+        state = _state_from_attr(head["state"]) if head else {}
+        version = int(head.get("version", {"N": "0"})["N"]) if head else 0
+        counter = int(head.get("turns", {"N": "0"})["N"]) if head else 0
+        return {"history": turns[-limit:], "state": state, "version": version,
+                "turns": max([counter] + [m["turn"] for m in turns])}
+    except Exception:
+        return _empty_session()
+
+def save_session_turns(session_id, history, state, version=None, turns=None):
+    """-> (new version, turn counter)"""
+    last = max([turns or 0] + [m.get("turn", 0) for m in history])
+    new = [(last + i, m) for i, m in enumerate((m for m in history if "turn" not in m), 1)]
+    last += len(new)
+    new_version = (version or 0) + 1
+    # head first: its conditional write is what detects a concurrent writer
+    dynamo.put_item(
+        TableName=DDB_TURNS_TABLE,
+        Item={
+            "session_id": {"S": session_id},
+            "sk":         {"S": HEAD_SK},
+            "state":      _state_attr(state),
+            "turns":      {"N": str(last)},
+            "version":    {"N": str(new_version)},
             "updated_at": {"N": str(now_epoch())}
-        }
+        },
+        **(_version_condition(version) if version is not None else {})
     )
+    # one conditional put per message (batch writes can't carry a condition): never overwrite a turn
+    for turn, m in new:
+        try:
+            dynamo.put_item(TableName=DDB_TURNS_TABLE, Item=_turn_item(session_id, m, turn),
+                            ConditionExpression="attribute_not_exists(sk)")
+        except Exception as e:
+            if _error_code(e) == "ConditionalCheckFailedException":  # the head is ours: not a stale read
+                raise RuntimeError(f"session {session_id}: turn {turn} is already stored") from None
+            raise
+    for turn, m in new:
+        m["turn"] = turn
+    return new_version, last
 
 # =========================
 # Shopify Helpers
 # =========================
+def shopify_deadline():
+    """SHOPIFY_DEADLINE, cut down to what's left of the turn's budget."""
+    left = remaining_budget()
+    return SHOPIFY_DEADLINE if left is None else max(min(SHOPIFY_DEADLINE, left), 0.001)
+
 def shopify_get(path, params=None):
-    query = f"?{urllib.parse.urlencode(params)}" if params else ""
-    url = f"{SHOPIFY_STORE_URL}/admin/api/2025-01/{path}{query}"
-    req = urllib.request.Request(
-        url,
-        headers={
-            "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-    )
-    with urllib.request.urlopen(req) as resp:
-        return json.loads(resp.read().decode("utf-8"))
+    with span("shopify"):
+        return shopify.get(path, params, deadline=shopify_deadline())
 
 def get_customer_by_email(email: str):
     data = shopify_get("customers/search.json", {"query": f"email:{email}"})
@@ -460,6 +1288,52 @@ def get_customer_by_email(email: str):
 def get_orders_by_customer(customer_id: str):
     return shopify_get("orders.json", {"customer_id": customer_id, "status": "any"}).get("orders", [])
 
+# Customer + latest order in one round trip, only the fields summarize_order() reads.
+LATEST_ORDER_QUERY = """
+query LatestOrder($query: String!) {
+  customers(first: 1, query: $query) {
+    edges { node {
+      id
+      orders(first: 1, sortKey: CREATED_AT, reverse: true) {
+        edges { node {
+          name
+          createdAt
+          displayFulfillmentStatus
+          fulfillments(first: 1) { trackingInfo(first: 1) { number company } }
+        } }
+      }
+    } }
+  }
+}
+"""
+
+# GraphQL enum -> the REST fulfillment_status summarize_order() expects (None reads "unfulfilled")
+_GQL_FULFILLMENT = {"FULFILLED": "fulfilled", "PARTIALLY_FULFILLED": "partial",
+                    "RESTOCKED": "restocked", "UNFULFILLED": None}
+
+def get_latest_order_by_email(email: str):
+    """(customer, latest order) via one GraphQL call; order is REST-shaped for summarize_order()."""
+    with span("shopify"):
+        data = shopify.graphql(LATEST_ORDER_QUERY, {"query": f"email:{email}"}, deadline=shopify_deadline())
+    edges = data.get("customers", {}).get("edges", [])
+    if not edges:
+        return None, None
+    customer = edges[0]["node"]
+    orders = customer.get("orders", {}).get("edges", [])
+    if not orders:
+        return customer, None
+    o = orders[0]["node"]
+    status = o.get("displayFulfillmentStatus")
+    order = {
+        "order_number": re.sub(r"\D", "", o["name"]) or o["name"],
+        "created_at": o["createdAt"],
+        "fulfillment_status": _GQL_FULFILLMENT.get(status, (status or "").lower() or None),
+        "fulfillments": [{"tracking_number": (f.get("trackingInfo") or [{}])[0].get("number"),
+                          "tracking_company": (f.get("trackingInfo") or [{}])[0].get("company")}
+                         for f in o.get("fulfillments") or []],
+    }
+    return customer, order
+
 def summarize_order(order):
     number = order["order_number"]
     created = datetime.fromisoformat(order["created_at"].replace("Z","+00:00")).strftime("%b %d")
@@ -474,11 +1348,95 @@ def summarize_order(order):
     return reply
 
 
+# =========================
+# Order-status cache (invalidated by Shopify webhooks)
+# =========================
+# Two tiers keyed by lowercased email: a short-TTL in-container LRU in front of a shared
+# DynamoDB entry ("order#<email>" in ORDER_CACHE_TABLE). Webhooks refresh/delete the shared
+# entry, so other warm containers see an update within ORDER_CACHE_LOCAL_TTL.
+ORDER_CACHE = LRUCache(ORDER_CACHE_SIZE, ttl=ORDER_CACHE_LOCAL_TTL)
+
+def _order_key(email): return f"order#{email.strip().lower()}"
+
+def _iso_epoch(s):
+    return datetime.fromisoformat(s.replace("Z", "+00:00")).timestamp() if s else 0.0
+
+def order_cache_get(email):
+    key = _order_key(email)
+    entry = ORDER_CACHE.get(key)
+    if entry is not _MISS:
+        return entry
+    try:
+        with span("order_cache_read"):
+            r = dynamo.get_item(TableName=ORDER_CACHE_TABLE, Key={"session_id": {"S": key}})
+    except Exception:
+        return None
+    item = r.get("Item")
+    try:
+        if not item or int(item["expires_at"]["N"]) <= now_epoch():
+            return None
+        entry = {"reply": item["reply"]["S"], "created_at": item["created_at"]["S"]}
+    except (KeyError, TypeError, ValueError):
+        return None  # not an order-cache entry: a miss, and the next put replaces it
+    ORDER_CACHE.put(key, entry)
+    return entry
+
+def order_cache_put(email, reply, created_at):
+    key = _order_key(email)
+    ORDER_CACHE.put(key, {"reply": reply, "created_at": created_at})
+    if _SCRATCH.get() is not None: return
+    try:
+        dynamo.put_item(TableName=ORDER_CACHE_TABLE, Item={
+            "session_id": {"S": key},
+            "reply":      {"S": reply},
+            "created_at": {"S": created_at},
+            "expires_at": {"N": str(now_epoch() + ORDER_CACHE_TTL)}   # also usable as the table's TTL attribute
+        })
+    except Exception:
+        pass
+
+def order_cache_delete(email):
+    key = _order_key(email)
+    ORDER_CACHE.pop(key)
+    dynamo.delete_item(TableName=ORDER_CACHE_TABLE, Key={"session_id": {"S": key}})
+
+def verify_shopify_hmac(raw_body: bytes, signature: str) -> bool:
+    import base64, hmac
+    if not SHOPIFY_WEBHOOK_SECRET or not signature:
+        return False
+    digest = hmac.new(SHOPIFY_WEBHOOK_SECRET.encode("utf-8"), raw_body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode("ascii"), signature.strip())
+
+def handle_shopify_webhook(event, headers):
+    """orders/updated refreshes a cached summary (if it's the latest order); fulfillments/create drops it."""
+    import base64
+    raw = event.get("body") or ""
+    raw = base64.b64decode(raw) if event.get("isBase64Encoded") else raw.encode("utf-8")
+    if not verify_shopify_hmac(raw, headers.get("x-shopify-hmac-sha256", "")):
+        return _resp(401, {"error": "invalid webhook signature"})
+    topic = headers.get("x-shopify-topic", "")
+    payload = json.loads(raw or b"{}")
+
+    if topic == "orders/updated":
+        email = payload.get("email") or (payload.get("customer") or {}).get("email")
+        cached = order_cache_get(email) if email else None
+        if cached and _iso_epoch(payload.get("created_at")) >= _iso_epoch(cached["created_at"]):
+            order_cache_put(email, summarize_order(payload), payload["created_at"])
+    elif topic == "fulfillments/create":
+        email = payload.get("email")
+        if not email and payload.get("order_id"):
+            order = shopify_get(f"orders/{payload['order_id']}.json", {"fields": "email,customer"}).get("order", {})
+            email = order.get("email") or (order.get("customer") or {}).get("email")
+        if email:
+            order_cache_delete(email)
+    return _resp(200, {"ok": True, "topic": topic})
+
 # =========================
 # LLM helpers (fallback + brand tone)
 # =========================
 def _clean_brand_text(t: str) -> str:
     """Strip prefaces like 'Here is the rewritten message...', code fences, quotes."""
+    import html
     if not t: return t
     s = t.strip()
     s = re.sub(r"^```(?:\w+)?\s*", "", s)
@@ -504,81 +1462,549 @@ def brand_tone(text):
             "<|start_header_id|>assistant<|end_header_id|>\n"
         )
         payload = {"prompt": prompt, "max_gen_len": 280, "temperature": 0.15}
-        r = bedrock.invoke_model(
-            modelId=MODEL_ID, body=json.dumps(payload),
-            accept="application/json", contentType="application/json",
-        )
-        data = json.loads(r["body"].read())
+        with span("bedrock_brand_tone"):
+            data = within_budget(_invoke_json, json.dumps(payload), min_s=LLM_MIN_BUDGET_MS / 1000)
         raw  = (data.get("generation") or "").strip()
         return _clean_brand_text(raw) or text
+    except DeadlineExceeded:
+        note_degraded("brand_tone", "template")
+        return text
     except Exception:
         return text
 
-def llm_reply(history, user_message):
-    last = history[-10:]
+# Brand-toned FAQ answers, keyed by MODEL_ID + answer hash so an edited answer or a new model misses.
+def brand_tone_key(text):
+    return f"{MODEL_ID}:{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+
+def load_brand_tone_cache(path=None, faqs=None):
+    """Entries of the prebuilt artifact that still match an answer of `faqs` (default: the
+    installed bank's) and MODEL_ID."""
+    try:
+        with open(path or BRAND_TONE_CACHE_PATH, encoding="utf-8") as f:
+            entries = json.load(f).get("entries", {})
+    except (OSError, ValueError):
+        return {}
+    faqs = faqs if faqs is not None else _BANK.faqs if _BANK else FAQS
+    live = {brand_tone_key(it["a"]) for it in faqs}
+    return {k: v for k, v in entries.items() if k in live}
+
+BRAND_TONE_CACHE = load_brand_tone_cache()
+
+def prune_brand_tone_cache(bank):
+    live = {brand_tone_key(it["a"]) for it in bank.faqs}
+    for k in [k for k in BRAND_TONE_CACHE if k not in live]:
+        BRAND_TONE_CACHE.pop(k, None)
+
+def faq_brand_tone(text):
+    key = brand_tone_key(text)
+    toned = BRAND_TONE_CACHE.get(key)
+    if toned is None:
+        toned = brand_tone(text)
+        if toned != text:  # brand_tone() returns the input on failure; don't pin that
+            BRAND_TONE_CACHE[key] = toned
+    return toned
+
+def estimate_tokens(text):
+    """Rough Llama 3 token count without a tokenizer: ~4 chars per token, ~1 token per CJK char."""
+    if not text: return 0
+    cjk = sum(len(run) for run in _CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+_MSG_OVERHEAD = 5  # header + eot tokens around each message
+
+def _summary_line(m):
+    text = re.sub(r"<[^>]+>", " ", m["content"])         # assistant replies may carry links
+    text = normalize(re.split(r"(?<=[.!?。！？])\s", text, 1)[0])
+    return f"{m['role']}: {text[:160]}"
+
+def fold_summary(summary, messages, budget=None):
+    """Append one clipped line per message; drop the oldest lines past the budget."""
+    budget = budget or PROMPT_SUMMARY_TOKENS
+    lines = (summary.splitlines() if summary else []) + [_summary_line(m) for m in messages]
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > budget:
+        lines.pop(0)
+    return "\n".join(lines)
+
+def budget_history(history, state, budget=None):
+    """Newest messages that fit `budget` tokens. Messages that fall out of the window are folded
+    into state["summary"] once; state["summary_upto"] counts the messages already folded.
+
+    commit_session runs this on every save, whichever handler answered the turn, and the window
+    stays short of SESSION_HISTORY_TURNS, so the per-turn store's loaded tail always starts at or
+    before summary_upto. (A session saved before that was true may have a gap; the summary then
+    picks up at the start of the tail.)"""
+    budget = budget or PROMPT_HISTORY_TOKENS
+    max_msgs = max(SESSION_HISTORY_TURNS - 2, 2)
+    base = history[0].get("turn", 1) - 1 if history else 0   # per-turn store loads only a tail
+    keep, used = [], 0
+    for m in reversed(history):
+        cost = estimate_tokens(m["content"]) + _MSG_OVERHEAD
+        if used + cost > budget or len(keep) >= max_msgs: break
+        keep.append(m)
+        used += cost
+    keep.reverse()
+    dropped = len(history) - len(keep)
+    done = state.get("summary_upto", 0)
+    if base + dropped > done:
+        state["summary"] = fold_summary(state.get("summary", ""), history[max(0, done - base):dropped])
+        state["summary_upto"] = base + dropped
+    return keep
+
+def _llm_payload(history, user_message, state=None):
+    if history and history[-1]["role"] == "user" and history[-1]["content"] == user_message:
+        history = history[:-1]  # the current message is appended below
+    state = {} if state is None else state
     conv = []
-    for m in last:
+    for m in budget_history(history, state):
         conv.append(f"<|start_header_id|>{m['role']}<|end_header_id|>\n{m['content']}\n<|eot_id|>")
     conv.append(f"<|start_header_id|>user<|end_header_id|>\n{user_message}\n<|eot_id|>")
     sys = ("You are a friendly assistant for a pet food store called Hi Nature! Pet. "
            "Keep replies brief, polite, and helpful.")
+    if state.get("summary"):
+        sys += "\nEarlier in this conversation:\n" + state["summary"]
     prompt = ("<|begin_of_text|>"
               f"<|start_header_id|>system<|end_header_id|>\n{sys}\n<|eot_id|>"
               + "".join(conv) +
               "<|start_header_id|>assistant<|end_header_id|>\n")
-    payload = {"prompt": prompt, "max_gen_len": 400, "temperature": 0.3}
-    r = bedrock.invoke_model(
-        modelId=MODEL_ID, body=json.dumps(payload),
-        accept="application/json", contentType="application/json",
-    )
-    data = json.loads(r["body"].read())
+    return {"prompt": prompt, "max_gen_len": 400, "temperature": 0.3}
+
+_STOPWORDS = frozenset("""a an the is are was were be been am do does did can could should would will
+    shall may might must i me my we our you your he she it its they them their his her this that these
+    those to of for in on at by with from and or but so if about as any some there what which please""".split())
+_WORD_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]|[^\W\d_]+|\d+")
+
+def _close_word(w, others):
+    """w is one of `others` up to a plural "s", or (5+ letters) a misspelling of one of them."""
+    if w in others or w.rstrip("s") in {o.rstrip("s") for o in others}: return True
+    if len(w) < 5 or w.isdigit(): return False
+    from difflib import SequenceMatcher
+    return any(len(o) >= 4 and SequenceMatcher(None, w, o).ratio() >= 0.85 for o in others)
+
+def same_content(a, b):
+    """Near-identical wordings can still ask different questions ("pregnant dog" / "pregnant cat"):
+    every content word (not a stopword; CJK: each character) on each side needs a counterpart
+    among the other side's words."""
+    wa, wb = set(_WORD_RE.findall(a)), set(_WORD_RE.findall(b))
+    return all(_close_word(w, wb) for w in wa - wb - _STOPWORDS) and \
+           all(_close_word(w, wa) for w in wb - wa - _STOPWORDS)
+
+class ResponseCache:
+    """Replies to context-free fallback questions, found by normalized text or, failing that,
+    by the closest cached wording whose SequenceMatcher ratio reaches `similarity` and which
+    shares its content words (same_content)."""
+    def __init__(self, maxsize, ttl, similarity):
+        self._lru = LRUCache(maxsize, ttl=ttl)
+        self.similarity = similarity
+        self.exact_hits = self.near_hits = self.misses = 0
+
+    @staticmethod
+    def key(text): return normalize(re.sub(r"[^\w\s]", " ", (text or "").lower()))
+
+    def get(self, text):
+        key = self.key(text)
+        if not key or self._lru.maxsize <= 0: return None
+        reply = self._lru.get(key)
+        if reply is not _MISS:
+            self.exact_hits += 1
+            return reply
+        near = self._nearest(key)
+        reply = self._lru.get(near) if near else _MISS
+        if reply is not _MISS:
+            self.near_hits += 1
+            return reply
+        self.misses += 1
+        return None
+
+    def _nearest(self, key):
+        from difflib import SequenceMatcher
+        sm = SequenceMatcher(None, "", key)  # query as seq2: its index is built once
+        best, best_key = self.similarity, None
+        for k in self._lru.keys():
+            sm.set_seq1(k)
+            if sm.real_quick_ratio() < best or sm.quick_ratio() < best: continue
+            r = sm.ratio()
+            if r >= best and same_content(key, k): best, best_key = r, k
+        return best_key
+
+    def put(self, text, reply):
+        key = self.key(text)
+        if key and reply: self._lru.put(key, reply)
+
+    def stats(self):
+        lookups = self.exact_hits + self.near_hits + self.misses
+        return {"size": len(self._lru), "exact_hits": self.exact_hits, "near_hits": self.near_hits,
+                "misses": self.misses, "evictions": self._lru.evictions,
+                "hit_rate": round((self.exact_hits + self.near_hits) / lookups, 4) if lookups else 0.0}
+
+LLM_CACHE = ResponseCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, LLM_CACHE_SIMILARITY)
+
+def _invoke_json(body):
+    r = bedrock.invoke_model(modelId=MODEL_ID, body=body,
+                             accept="application/json", contentType="application/json")
+    return json.loads(r["body"].read())
+
+def _invoke_stream(body):
+    return bedrock.invoke_model_with_response_stream(modelId=MODEL_ID, body=body,
+                                                     accept="application/json", contentType="application/json")
+
+def llm_reply(history, user_message, state=None):
+    """Raises DeadlineExceeded if the turn's budget runs out first (see degraded_reply)."""
+    body = json.dumps(_llm_payload(history, user_message, state))
+    with span("bedrock"):
+        data = within_budget(_invoke_json, body, min_s=LLM_MIN_BUDGET_MS / 1000)
     return (data.get("generation") or "").strip()
 
+def llm_reply_stream(history, user_message, on_delta, state=None):
+    """Like llm_reply, but passes each generated chunk to on_delta() as Bedrock streams it.
+    If the budget runs out mid-reply, the text streamed so far is the reply."""
+    body = json.dumps(_llm_payload(history, user_message, state))
+    parts = []
+    with span("bedrock"):  # until the last chunk, on_delta writes included
+        stream = within_budget(_invoke_stream, body, min_s=LLM_MIN_BUDGET_MS / 1000)["body"]
+        try:
+            for event in iter_within_budget(stream):
+                chunk = event.get("chunk")
+                if not chunk: continue
+                text = json.loads(chunk["bytes"]).get("generation") or ""
+                if not parts: text = text.lstrip()  # match llm_reply's strip() on the leading side
+                if text:
+                    parts.append(text)
+                    on_delta(text)
+        except DeadlineExceeded:
+            if not parts: raise
+            note_degraded("llm", "truncated")
+        finally:
+            if hasattr(stream, "close"): stream.close()
+    return "".join(parts).strip()
+
+DEGRADED_REPLY = ("Sorry, I’m taking longer than usual to answer that. Please try again in a moment, "
+                  "or email hello@hinaturepet.com and our team will help.")
+
+def degraded_reply(user_message, stage="llm"):
+    """Stand-in for a reply that ran out of budget at `stage`: the closest FAQ answer if it's at
+    all relevant (the match is usually cached from detect_intent), else a holding message."""
+    score, item = best_faq_match(user_message)
+    if item and score >= DEGRADED_FAQ_MIN_SCORE:
+        note_degraded(stage, "faq")
+        return "I couldn’t put together a full answer just now, but this may help: " + item["a"]
+    note_degraded(stage, "holding")
+    return DEGRADED_REPLY
+
 # =========================
 # Intent detection
 # =========================
 KW_ORDER = ["order", "订单", "status", "where is my order", "track", "tracking"]
 KW_DELIV = ["deliver", "delivery", "shipping", "物流", "送货", "配送", "arrive", "到货"]
+KW_WHEN  = ["when", "arrive", "到货", "发货"]   # handle_faq: low-similarity delivery timing questions
+
+def build_keyword_automaton(faqs):
+    """One matcher for every routing keyword list and FAQ tag. Labels: ("route", intent),
+    ("hint", "delivery") and ("faq", index into faqs)."""
+    pairs  = [(k, ("route", "order_status")) for k in KW_ORDER]
+    pairs += [(k, ("route", "faq")) for k in KW_DELIV]  # delivery timing is an FAQ
+    pairs += [(k, ("hint", "delivery")) for k in KW_WHEN]
+    pairs += [(t, ("faq", i)) for i, item in enumerate(faqs) for t in item.get("tags", [])]
+    return KeywordAutomaton(pairs)
 
-def detect_intent(msg, explicit=None):
-    if explicit: return explicit
-    m = msg.lower()
-    if any(k in m for k in KW_ORDER): return "order_status"
-    if any(k in m for k in KW_DELIV): return "faq"  # delivery timing is an FAQ
-    score, _ = best_faq_match(m)
-    if score >= 0.70: return "faq"
+def routes_hash():
+    return hashlib.sha1(json.dumps([KW_ORDER, KW_DELIV, KW_WHEN], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def detect_intent(msg, explicit=None, bank=None):
+    return route_message(msg, explicit, bank)[0]
+
+def route_message(msg, explicit=None, bank=None):
+    """(intent, keyword hits): the hits are the message's one bank.keywords.scan(), cached with
+    the intent, so FAQ candidate selection and handle_faq reuse them (None for an explicit intent)."""
+    if explicit: return explicit, None
+    bank = bank or ensure_faqs()
+    key = _faq_cache_key("intent", msg, (FAQ_MATCH_MODE, FAQ_MATCH_THRESHOLD), bank)
+    with span("detect_intent"):
+        routed = FAQ_CACHE.get(key)
+        note_cache("intent", routed is not _MISS)
+        if routed is _MISS:
+            hits = bank.keywords.scan(key[3])
+            routed = (_detect_intent(bank, key[3], hits), hits)
+            FAQ_CACHE.put(key, routed)
+    return routed
+
+def _detect_intent(bank, m, hits):
+    routes = {label[1] for _, _, label in hits if label[0] == "route"}
+    if "order_status" in routes: return "order_status"
+    if "faq" in routes: return "faq"
+    score, _ = best_faq_match(m, hits=hits, bank=bank)
+    if score >= FAQ_MATCH_THRESHOLD: return "faq"
     return "fallback"
 
 # =========================
 # Escalation via SNS
 # =========================
+# enqueue() claims "esc#<session>#<kind>" in OUTBOX_TABLE with a conditional write (repeats
+# inside ESCALATION_DEDUPE_S are dropped), then the ticket is published:
+#   inline (default) -- before the turn returns; if SNS refuses it the claim is released and the
+#                       turn fails, so a retry escalates again instead of being deduped
+#   stream           -- off the request path, by outbox_stream_handler from the table's stream
+#   thread           -- off the request path, in batches of up to 10 on a background thread; only
+#                       for a process that keeps running after it responds (Lambda freezes the
+#                       container, and a queued ticket can be lost while its claim blocks a retry)
+# Event source mapping filter for the stream consumer: HN_Sessions also carries every chat turn,
+# which the consumer doesn't need to be invoked for.
+OUTBOX_STREAM_FILTER = {"Filters": [{"Pattern": json.dumps(
+    {"eventName": ["INSERT", "MODIFY"], "dynamodb": {"Keys": {"session_id": {"S": [{"prefix": "esc#"}]}}}})}]}
+
+class EscalationOutbox:
+    def __init__(self):
+        self._queue = deque()
+        self._cv = threading.Condition()
+        self._thread = None
+        self._inflight = 0
+        self._recent = LRUCache(1024, ttl=ESCALATION_DEDUPE_S)  # skips the DynamoDB claim for repeats
+        self.enqueued = self.deduped = self.published = self.failed = 0
+        self.flushes, self.flush_ms_total, self.last_flush_ms = 0, 0.0, 0.0
+
+    def enqueue(self, ticket):
+        """False if the same session already escalated this kind within the dedupe window."""
+        key = f"esc#{ticket['session_id']}#{ticket['type']}"
+        if self._recent.get(key) is not _MISS or not self._claim(key, ticket):
+            self._recent.put(key, True)
+            self.deduped += 1
+            return False
+        self._recent.put(key, True)
+        self.enqueued += 1
+        if OUTBOX_FLUSH == "inline":
+            try:
+                if self.publish_each([ticket]):
+                    raise RuntimeError("SNS did not accept the escalation ticket")
+            except Exception:
+                self._release(key)
+                raise
+        elif OUTBOX_FLUSH == "thread":
+            with self._cv:
+                self._queue.append(ticket)
+                self._cv.notify()
+            self._ensure_thread()
+        return True
+
+    def _claim(self, key, ticket):
+        if not OUTBOX_TABLE: return True  # in-memory stand-in: dedupe per container only
+        now = now_epoch()
+        try:
+            with span("outbox_claim"):
+                dynamo.put_item(
+                    TableName=OUTBOX_TABLE,
+                    Item={"session_id":  {"S": key},
+                          "ticket":      {"S": json.dumps(ticket, ensure_ascii=False)},
+                          "enqueued_at": {"N": str(now)}},
+                    ConditionExpression="attribute_not_exists(session_id) OR enqueued_at < :cutoff",
+                    ExpressionAttributeValues={":cutoff": {"N": str(now - ESCALATION_DEDUPE_S)}}
+                )
+            return True
+        except Exception as e:
+            if _error_code(e) == "ConditionalCheckFailedException": return False
+            raise
+
+    def _release(self, key):
+        self._recent.pop(key)
+        if OUTBOX_TABLE:
+            dynamo.delete_item(TableName=OUTBOX_TABLE, Key={"session_id": {"S": key}})
+
+    def _ensure_thread(self):
+        with self._cv:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._queue:
+                    self._cv.wait()
+                batch = [self._queue.popleft() for _ in range(min(10, len(self._queue)))]
+                self._inflight = len(batch)
+            try:
+                self.publish(batch)
+            except Exception:
+                pass  # counted in failed
+            with self._cv:
+                self._inflight = 0
+                self._cv.notify_all()
+
+    def publish(self, tickets):
+        """sns.publish_batch in chunks of 10; returns how many were accepted."""
+        return len(tickets) - len(self.publish_each(tickets))
+
+    def publish_each(self, tickets):
+        """Like publish(), but returns the indexes of the tickets SNS didn't accept; a chunk
+        whose call raised counts as failed as a whole once the rest have been tried."""
+        failed, error = [], None
+        for i in range(0, len(tickets), 10):
+            chunk = tickets[i:i+10]
+            t = time.perf_counter()
+            try:
+                r = sns.publish_batch(TopicArn=SNS_TOPIC_ARN, PublishBatchRequestEntries=[
+                    {"Id": str(n), "Subject": f"{BRAND_NAME}: {tk['type']} request",
+                     "Message": json.dumps(tk, ensure_ascii=False)}
+                    for n, tk in enumerate(chunk)
+                ])
+            except Exception as e:
+                error = error or e
+                r = {"Failed": [{"Id": str(n)} for n in range(len(chunk))]}
+            self.last_flush_ms = (time.perf_counter() - t) * 1000
+            self.flushes += 1
+            self.flush_ms_total += self.last_flush_ms
+            bad = [i + int(f["Id"]) for f in r.get("Failed", [])]
+            failed += bad
+            self.published += len(chunk) - len(bad)
+            self.failed += len(bad)
+            if METRICS_EMF:
+                emit_emf({"sns_publish": round(self.last_flush_ms, 3)}, {"Source": "outbox"},
+                         counts={"published": len(chunk) - len(bad), "failed": len(bad)})
+        if error is not None and len(failed) == len(tickets):
+            raise error  # nothing went out: let the caller retry the lot
+        return failed
+
+    def drain(self, timeout=5.0):
+        """Wait for the background queue to empty (shutdown, tests)."""
+        end = time.monotonic() + timeout
+        with self._cv:
+            while (self._queue or self._inflight) and time.monotonic() < end:
+                self._cv.wait(end - time.monotonic())
+            return not (self._queue or self._inflight)
+
+    def stats(self):
+        return {"depth": len(self._queue), "enqueued": self.enqueued, "deduped": self.deduped,
+                "published": self.published, "failed": self.failed,
+                "last_flush_ms": round(self.last_flush_ms, 2),
+                "avg_flush_ms": round(self.flush_ms_total / self.flushes, 2) if self.flushes else 0.0}
+
+OUTBOX = EscalationOutbox()
+
 def escalate_to_sns(kind, session_id, user_message, contact=None):
     if not SNS_TOPIC_ARN: return None
     payload = {
         "type": kind, "session_id": session_id, "message": user_message,
         "contact": contact, "ts": datetime.now(timezone.utc).isoformat()
     }
-    sns.publish(
-        TopicArn=SNS_TOPIC_ARN,
-        Subject=f"{BRAND_NAME}: {kind} request",
-        Message=json.dumps(payload, ensure_ascii=False)
-    )
+    if _SCRATCH.get() is None:
+        OUTBOX.enqueue(payload)  # a repeat inside the dedupe window is already on its way
     return payload
 
+def outbox_stream_handler(event, context):
+    """DynamoDB Streams consumer for OUTBOX_TABLE (OUTBOX_FLUSH=stream); map it with
+    OUTBOX_STREAM_FILTER and ReportBatchItemFailures. Tickets SNS rejects are returned as
+    batchItemFailures, so Lambda retries from the first of them instead of dropping them."""
+    tickets, seqs = [], []
+    for rec in event.get("Records", []):
+        if rec.get("eventName") not in ("INSERT", "MODIFY"): continue
+        image = rec.get("dynamodb", {}).get("NewImage", {})
+        if image.get("session_id", {}).get("S", "").startswith("esc#") and "ticket" in image:
+            tickets.append(json.loads(image["ticket"]["S"]))
+            seqs.append(rec["dynamodb"].get("SequenceNumber"))
+    failed = OUTBOX.publish_each(tickets)
+    return {"batchItemFailures": [{"itemIdentifier": seqs[i]} for i in failed],
+            "published": len(tickets) - len(failed), "outbox": OUTBOX.stats()}
+
 # =========================
 # Handlers
 # =========================
-def handle_faq(user_message):
-    score, item = best_faq_match(user_message)
-    if not item or score < 0.70:
+def handle_faq(user_message, bank=None, hits=None):
+    """`hits`: the message's keyword scan from route_message(), if there was one."""
+    bank = bank or ensure_faqs()
+    if hits is None: hits = bank.keywords.scan(normalize(user_message).lower())
+    score, item = best_faq_match(user_message, hits=hits, bank=bank)
+    if not item or score < FAQ_MATCH_THRESHOLD:
         # If user text smells like delivery but similarity is low, force delivery FAQ.
-        if any(k in user_message.lower() for k in ["when", "arrive", "到货", "发货"]):
-            for it in FAQS:
+        if any(label == ("hint", "delivery") for _, _, label in hits):
+            for it in bank.faqs:
                 if "When will I receive my delivery?" in it["q"]:
                     item = it; break
         if not item: return None
     text = item["a"]
-    return brand_tone(text) if USE_BRAND_TONE_FOR_FAQ else text
+    return faq_brand_tone(text) if USE_BRAND_TONE_FOR_FAQ else text
+
+# ---- FAQ bundle (answered in the widget) ----
+def faq_id(item): return hashlib.sha1(item["q"].encode("utf-8")).hexdigest()[:10]
+
+def _faq_answer_text(item):
+    """The answer as handle_faq would show it, without calling Bedrock."""
+    if USE_BRAND_TONE_FOR_FAQ:
+        return BRAND_TONE_CACHE.get(brand_tone_key(item["a"]), item["a"])
+    return item["a"]
+
+_faq_bundle = None  # (bank hash, etag, body)
+
+def faq_bundle():
+    """(etag, JSON body) of the widget bundle, rebuilt when the FAQ bank changes. Each FAQ
+    carries its answer and its lowercased question/tag strings ("m") for the client matcher;
+    messages with a server_keywords hit always go to the server."""
+    global _faq_bundle
+    bank = ensure_faqs()
+    if _faq_bundle is None or _faq_bundle[0] != bank.hash:
+        strings = bank.index["strings"]
+        faqs = [{"id": faq_id(it), "a": _faq_answer_text(it),
+                 "m": list(dict.fromkeys(strings[a:b]))}
+                for it, (a, b) in zip(bank.faqs, bank.index["spans"])]
+        body = json.dumps({"version": bank.hash[:16], "threshold": FAQ_CLIENT_THRESHOLD,
+                           "server_keywords": KW_ORDER, "faqs": faqs},
+                          ensure_ascii=False, separators=(",", ":"))
+        etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest()[:20] + '"'
+        _faq_bundle = (bank.hash, etag, body)
+    return _faq_bundle[1], _faq_bundle[2]
+
+def handle_faq_bundle(headers):
+    etag, body = faq_bundle()
+    not_modified = etag in headers.get("if-none-match", "")
+    r = _resp(304 if not_modified else 200, {})
+    r["body"] = "" if not_modified else body
+    r["headers"].update({
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={FAQ_BUNDLE_MAX_AGE}, s-maxage={FAQ_BUNDLE_CDN_MAX_AGE}, "
+                         f"stale-while-revalidate={FAQ_BUNDLE_MAX_AGE}",
+    })
+    return r
+
+def widget_turns(records, session_id, bank=None):
+    """History messages for the widget's locally answered turns of one session, oldest first.
+    The reply is looked up by faq_id, never taken from the client."""
+    by_id = {faq_id(it): it for it in (bank or ensure_faqs()).faqs}
+    now, out = now_epoch(), []
+    for rec in records:
+        if not isinstance(rec, dict) or rec.get("session_id", session_id) != session_id: continue
+        msg = normalize(rec.get("message"))
+        if not msg: continue
+        ts = rec.get("ts")
+        ts = min(int(ts), now) if isinstance(ts, (int, float)) else now
+        item = by_id.get(rec.get("faq_id"))
+        reply = _faq_answer_text(item) if item else "(answered in the widget from an earlier FAQ bundle)"
+        out.append((ts, msg, reply))
+    out.sort(key=lambda t: t[0])
+    return [m for ts, msg, reply in out
+            for m in ({"role": "user", "content": msg, "ts": ts},
+                      {"role": "assistant", "content": reply, "ts": ts, "intent": "faq", "source": "widget"})]
+
+def handle_faq_log(body):
+    """{"faq_log": [{"session_id", "message", "faq_id", "ts"}, ...]}: turns the widget answered
+    from the bundle, appended to their sessions (sent on a timer or as the page goes away)."""
+    records = body.get("faq_log") or []
+    if len(records) > FAQ_LOG_MAX_RECORDS:
+        return 400, {"error": f"faq_log too large (max {FAQ_LOG_MAX_RECORDS} records)"}
+    bank = ensure_faqs()
+    sessions = OrderedDict()
+    for rec in records:
+        sid = (rec.get("session_id") or "").strip() if isinstance(rec, dict) else ""
+        if sid and valid_session_id(sid):
+            sessions.setdefault(sid, []).append(rec)
+    logged = 0
+    for sid, recs in sessions.items():
+        turns = widget_turns(recs, sid, bank)
+        if not turns: continue
+        session = load_session(sid)
+        loaded = len(session["history"])
+        session["history"].extend(turns)
+        commit_session(sid, session, loaded)
+        logged += len(turns) // 2
+    if METRICS_EMF:
+        emit_emf({}, {"Source": "widget"}, counts={"faq_local": logged})
+    return 200, {"logged": logged}
 
 def handle_escalation(kind, session_id, user_message, state):
     ticket = escalate_to_sns(kind, session_id, user_message, contact=state.get("contact"))
@@ -589,98 +2015,461 @@ def handle_escalation(kind, session_id, user_message, state):
         return ("I can flag this for a human, but SNS isn’t configured. "
                 "Please contact support, or set SNS_TOPIC_ARN in the backend.")
     
-def handle_order_status(session_id, user_message, state):
+EMAIL_RE = re.compile(r"[\w\.-]+@[\w\.-]+")
+
+def handle_order_status(session_id, user_message, state, prefetch=None):
+    """`prefetch` is an optional (email, Future) from lookup_order_status started ahead of time."""
     # Step 1. Extract email
     email = state.get("contact")
     if not email:
-        match = re.search(r"[\w\.-]+@[\w\.-]+", user_message)
+        match = EMAIL_RE.search(user_message)
         if match:
             email = match.group(0)
             state["contact"] = email
         else:
             return "Can you please provide the email you used for your order?"
 
+    if prefetch and prefetch[0] == email:
+        try:
+            return result_within_budget(prefetch[1])
+        except DeadlineExceeded:  # the lookup still finishes and fills the order cache
+            note_degraded("order_lookup", "retry")
+            return "Our order system is slow to answer right now. Please ask again in a moment."
+    return lookup_order_status(email)
+
+def lookup_order_status(email):
+    cached = order_cache_get(email)
+    note_cache("order", bool(cached))
+    if cached:
+        return cached["reply"]
+    reply, created_at = fetch_order_status(email)
+    if created_at is not None:
+        order_cache_put(email, reply, created_at)
+    return reply
+
+def fetch_order_status(email):
+    """(reply, created_at of the latest order) -- created_at is "" when the customer has no
+    orders and None when the reply shouldn't be cached (errors, unknown customer)."""
+    # Step 2 (GraphQL). Customer + latest order in one call
+    if SHOPIFY_ORDER_LOOKUP == "graphql":
+        try:
+            customer, latest = get_latest_order_by_email(email)
+        except Exception:
+            return "Sorry, I wasn’t able to reach our order system. Please try again later.", None
+        if not customer:
+            return f"We couldn’t find any customer with {email}. You may not have an account with us yet.", None
+        if not latest:
+            return f"We found your profile but no orders linked to {email}.", ""
+        return summarize_order(latest), latest["created_at"]
+
     # Step 2. Fetch customer
     try:
         customers = get_customer_by_email(email)
     except Exception as e:
-        return "Sorry, I wasn’t able to reach our order system. Please try again later."
+        return "Sorry, I wasn’t able to reach our order system. Please try again later.", None
 
     if not customers:
-        return f"We couldn’t find any customer with {email}. You may not have an account with us yet."
+        return f"We couldn’t find any customer with {email}. You may not have an account with us yet.", None
 
     # Step 3. Fetch orders
     try:
         customer_id = customers[0]["id"]
         orders = get_orders_by_customer(customer_id)
     except Exception:
-        return "Sorry, I wasn’t able to retrieve your orders. Please try again later."
+        return "Sorry, I wasn’t able to retrieve your orders. Please try again later.", None
 
     if not orders:
-        return f"We found your profile but no orders linked to {email}."
+        return f"We found your profile but no orders linked to {email}.", ""
 
     # Step 4. Return latest order summary
     latest = orders[0]
-    return summarize_order(latest)
+    return summarize_order(latest), latest["created_at"]
 
 
-# =========================a
+# =========================
+# Idempotent turns
+# =========================
+# A turn's key is claimed before any upstream call: first locally (duplicates inside this container
+# wait on an Event), then with a conditional put of "idem#<key>" in IDEMPOTENCY_TABLE, so a retry
+# landing on another container finds the claim and polls for the stored result instead.
+IN_PROGRESS = object()
+
+def idempotency_key(body):
+    """sha256 of session_id + request_id, or of session_id + message + "turn"; None without either."""
+    sid = (body.get("session_id") or "").strip()
+    rid = str(body.get("request_id") or "").strip()
+    if rid:
+        raw = f"{sid}\nrid\n{rid}"
+    elif sid and isinstance(body.get("turn"), int):
+        raw = f"{sid}\nturn\n{body['turn']}\n{normalize(body.get('message'))}"
+    else:
+        return None
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class IdempotencyStore:
+    def __init__(self):
+        self._results = LRUCache(2048, ttl=IDEMPOTENCY_TTL)
+        self._inflight = {}  # key -> Event set when the local owner finishes or gives up
+        self._lock = threading.Lock()
+        self.claimed = self.replayed = self.timeouts = 0
+
+    def claim(self, key):
+        """None: the caller owns the turn and must finish() or release() it. Otherwise the first
+        delivery's [code, response], or IN_PROGRESS if it didn't finish within the lease."""
+        end = time.monotonic() + IDEMPOTENCY_LEASE_S
+        while True:
+            with self._lock:
+                hit = self._results.get(key)
+                if hit is not _MISS:
+                    self.replayed += 1
+                    return hit
+                ev = self._inflight.get(key)
+                if ev is None:
+                    self._inflight[key] = threading.Event()
+                    break
+            if not ev.wait(max(0.0, end - time.monotonic())):
+                self.timeouts += 1
+                return IN_PROGRESS
+        try:
+            hit = None if self._claim_shared(key) else self._wait_shared(key, end)
+        except Exception:
+            self._settle(key)
+            raise
+        if hit is None:
+            self.claimed += 1
+            return None
+        self._settle(key, None if hit is IN_PROGRESS else hit)
+        if hit is IN_PROGRESS: self.timeouts += 1
+        else: self.replayed += 1
+        return hit
+
+    def finish(self, key, code, obj):
+        result = [code, obj]
+        try:
+            if self._shared():
+                dynamo.put_item(TableName=IDEMPOTENCY_TABLE, Item={
+                    "session_id": {"S": f"idem#{key}"},
+                    "status":     {"S": "done"},
+                    "result":     {"S": json.dumps(result, ensure_ascii=False)},
+                    "expires_at": {"N": str(now_epoch() + IDEMPOTENCY_TTL)}  # also usable as the table's TTL attribute
+                })
+        finally:
+            self._settle(key, copy.deepcopy(result))
+
+    def release(self, key):
+        """Give the key up (the turn failed), so a retry runs it again."""
+        try:
+            if self._shared():
+                dynamo.delete_item(TableName=IDEMPOTENCY_TABLE, Key={"session_id": {"S": f"idem#{key}"}})
+        finally:
+            self._settle(key)
+
+    def _settle(self, key, result=None):
+        with self._lock:
+            if result is not None: self._results.put(key, result)
+            ev = self._inflight.pop(key, None)
+        if ev is not None: ev.set()
+
+    def _shared(self): return bool(IDEMPOTENCY_TABLE)
+
+    def _claim_shared(self, key):
+        if not self._shared(): return True
+        now = now_epoch()
+        try:
+            with span("idempotency_claim"):
+                dynamo.put_item(
+                    TableName=IDEMPOTENCY_TABLE,
+                    Item={"session_id": {"S": f"idem#{key}"},
+                          "status":     {"S": "pending"},
+                          "expires_at": {"N": str(now + IDEMPOTENCY_LEASE_S)}},
+                    ConditionExpression="attribute_not_exists(session_id) OR expires_at < :now",
+                    ExpressionAttributeValues={":now": {"N": str(now)}}
+                )
+            return True
+        except Exception as e:
+            if _error_code(e) == "ConditionalCheckFailedException": return False
+            raise
+
+    def _wait_shared(self, key, end):
+        """Poll until the owner stores its result (-> result), drops its claim and we take it
+        over (-> None), or `end` passes (-> IN_PROGRESS)."""
+        delay = 0.05
+        while True:
+            item = dynamo.get_item(TableName=IDEMPOTENCY_TABLE, Key={"session_id": {"S": f"idem#{key}"}},
+                                   ConsistentRead=True).get("Item")
+            live = item is not None and int(item.get("expires_at", {"N": "0"})["N"]) >= now_epoch()
+            if live and item.get("status", {}).get("S") == "done":
+                return json.loads(item["result"]["S"])
+            if not live and self._claim_shared(key):
+                return None
+            if time.monotonic() + delay >= end:
+                return IN_PROGRESS
+            time.sleep(delay)
+            delay = min(delay * 2, 0.4)
+
+    def stats(self):
+        return {"claimed": self.claimed, "replayed": self.replayed, "timeouts": self.timeouts,
+                "inflight": len(self._inflight), "results": len(self._results)}
+
+IDEMPOTENCY = IdempotencyStore()
+
+# =========================
 # Lambda entry
 # =========================
-def lambda_handler(event, context):
+def handle_turn(body, on_delta=None):
+    """One chat turn -> (status, response). With on_delta, fallback LLM text is streamed through it.
+    A repeated request_id (or turn) within IDEMPOTENCY_TTL gets the first delivery's response."""
+    key = idempotency_key(body) if IDEMPOTENCY_TTL > 0 and _SCRATCH.get() is None else None
+    if key is None:
+        return _budgeted_turn(body, on_delta)
+    prior = IDEMPOTENCY.claim(key)
+    if prior is IN_PROGRESS:
+        return 409, {"error": "this request is still being processed; retry shortly", "retry": True}
+    if prior is not None:
+        code, obj = copy.deepcopy(prior)
+        obj.setdefault("meta", {})["idempotent_replay"] = True
+        if on_delta and obj.get("reply"): on_delta(obj["reply"])
+        if METRICS_EMF: emit_emf({}, {"Source": "idempotency"}, counts={"replayed": 1})
+        return code, obj
     try:
-        body = json.loads(event.get("body") or "{}")
-        session_id      = (body.get("session_id") or "").strip() or str(uuid.uuid4())
-        user_message    = normalize(body.get("message"))
-        explicit_intent = body.get("intent")
+        code, obj = _budgeted_turn(body, on_delta)
+    except BaseException:
+        IDEMPOTENCY.release(key)
+        raise
+    if code == 200 and not obj["meta"].get("unsaved"):
+        IDEMPOTENCY.finish(key, code, obj)
+    else:
+        IDEMPOTENCY.release(key)
+    return code, obj
 
-        if not user_message:
-            return _resp(400, {"error": "message required"})
+def _budgeted_turn(body, on_delta):
+    budget = _BUDGET.set(Budget(turn_budget_ms(body), cap=_INVOKE_DEADLINE.get()))
+    try:
+        if not (METRICS_EMF or DEBUG_TIMINGS):
+            return _handle_turn(body, on_delta)
+        m = TurnMetrics()
+        token = _TURN.set(m)
+        try:
+            code, obj = _handle_turn(body, on_delta)
+        finally:
+            _TURN.reset(token)
+    finally:
+        _BUDGET.reset(budget)
+    if code == 200:
+        if METRICS_EMF: emit_turn_metrics(m, obj)
+        if DEBUG_TIMINGS: obj["meta"]["timings"] = turn_timings(m)
+    return code, obj
 
-        session = load_session(session_id)
-        history = session["history"]
-        state   = session["state"]
+def _handle_turn(body, on_delta):
+    session_id      = (body.get("session_id") or "").strip() or str(uuid.uuid4())
+    user_message    = normalize(body.get("message"))
+    explicit_intent = body.get("intent")
 
-        # record user
-        history.append({"role": "user", "content": user_message, "ts": now_epoch()})
+    if not user_message:
+        return 400, {"error": "message required"}
+    if not valid_session_id(session_id):
+        return 400, {"error": "invalid session_id"}
+    bank = ensure_faqs()  # this turn's FAQ snapshot, even if a newer bank is installed meanwhile
+    refresh_faq_artifact()
 
-        # ---- intent handling ----
-        # if we're already inside an order_status flow, STAY there
-        prev_intent = history[-2]["intent"] if len(history) >= 2 else None
-        if prev_intent == "order_status" and "resolved" not in state:
-            intent = "order_status"
-        else:
-            intent = detect_intent(user_message, explicit=explicit_intent)
-
-        reply_payload = {}
-        reply_text = None
-
-        if intent == "faq":
-            reply_text = handle_faq(user_message) or \
-                         "For deliveries: orders before Friday 23:59 ship Tue/Wed; transit 1–3 business days."
-        elif intent == "order_status":
-            reply_text = handle_order_status(session_id, user_message, state)
-            # mark resolved so we don’t loop forever
-            if "order #" in reply_text.lower():
-                state["resolved"] = True
-        elif intent == "delivery":
-            reply_text = handle_escalation("delivery", session_id, user_message, state)
+    # ---- stage 1: session read || intent scoring || speculative order lookup ----
+    session_f = submit(load_session, session_id)
+    email_m   = EMAIL_RE.search(user_message)
+    prefetch  = (email_m.group(0), submit(lookup_order_status, email_m.group(0))) if email_m else None
+    scored_intent, hits = route_message(user_message, explicit=explicit_intent, bank=bank)
+
+    try:
+        session = result_within_budget(session_f)
+    except DeadlineExceeded:
+        # can't reply in context or save on top of a session we haven't read: answer, keep nothing
+        reply_text = degraded_reply(user_message, stage="load_session")
+        if on_delta: on_delta(reply_text)
+        budget = _BUDGET.get()
+        return 200, {"reply": reply_text, "intent": scored_intent, "session_id": session_id, "state": {},
+                     "meta": {"degraded": budget.degraded, "budget_ms": budget.ms, "unsaved": True}}
+    history = session["history"]
+    state   = session["state"]
+    loaded  = len(history)
+
+    # turns the widget answered from the FAQ bundle since its last request come first
+    if isinstance(body.get("faq_log"), list):
+        history.extend(widget_turns(body["faq_log"][:FAQ_LOG_MAX_RECORDS], session_id, bank))
+
+    # record user
+    history.append({"role": "user", "content": user_message, "ts": now_epoch()})
+
+    # ---- intent handling ----
+    # if we're already inside an order_status flow, STAY there
+    prev_intent = history[-2]["intent"] if len(history) >= 2 else None
+    if prev_intent == "order_status" and "resolved" not in state:
+        intent = "order_status"
+    else:
+        intent = scored_intent
+
+    reply_payload = {}
+    reply_text = None
+
+    if intent == "faq":
+        reply_text = handle_faq(user_message, bank, hits) or \
+                     "For deliveries: orders before Friday 23:59 ship Tue/Wed; transit 1–3 business days."
+    elif intent == "order_status":
+        reply_text = handle_order_status(session_id, user_message, state, prefetch)
+        # mark resolved so we don’t loop forever
+        if "order #" in reply_text.lower():
+            state["resolved"] = True
+    elif intent == "delivery":
+        reply_text = handle_escalation("delivery", session_id, user_message, state)
+    else:
+        # first message with no summary (widget-answered faq_log turns count): the reply depends
+        # on the message alone, so it's shareable
+        context_free = len(history) == 1 and not state.get("summary")
+        reply_text = LLM_CACHE.get(user_message) if context_free else None
+        note_cache("llm", reply_text is not None)
+        if reply_text is not None:
+            if on_delta: on_delta(reply_text)
         else:
-            reply_text = llm_reply(history, user_message)
+            try:
+                if on_delta:
+                    reply_text = llm_reply_stream(history, user_message, on_delta, state)
+                else:
+                    reply_text = llm_reply(history, user_message, state)
+            except DeadlineExceeded:
+                reply_text = degraded_reply(user_message)
+                if on_delta: on_delta(reply_text)
+            if context_free and not _BUDGET.get().degraded:
+                LLM_CACHE.put(user_message, reply_text)
 
-        # record assistant
-        history.append({"role": "assistant", "content": reply_text, "ts": now_epoch(), "intent": intent})
+    # record assistant
+    history.append({"role": "assistant", "content": reply_text, "ts": now_epoch(), "intent": intent})
 
-        # persist
-        save_session(session_id, history, state)
+    budget = _BUDGET.get()
+    if budget.degraded:
+        reply_payload["degraded"] = budget.degraded
+        reply_payload["budget_ms"] = budget.ms
 
-        return _resp(200, {
-            "reply": reply_text,
-            "intent": intent,
-            "session_id": session_id,
-            "state": state,
-            "meta": reply_payload
-        })
+    # ---- stage 3: persist || build response (streamed replies are saved once fully assembled) ----
+    save_f = submit(commit_session, session_id, session, loaded)
+    response = {
+        "reply": reply_text,
+        "intent": intent,
+        "session_id": session_id,
+        "state": state,
+        "meta": reply_payload
+    }
+    save_f.result()  # finish before returning (budget or not): Lambda freezes the container afterwards
+    return 200, response
+
+_BATCH_POOL = Lazy(lambda: ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch"))
+
+def handle_batch(body):
+    """{"batch": [{"session_id", "message", "intent"}, ...], "persist": true} -> results in input order.
+
+    Sessions run concurrently on their own pool (handle_turn's stages use the shared one, and a
+    pooled task waiting on the same pool can deadlock); a session's turns run in order. With
+    "persist": false sessions start empty and live in a per-batch dict, and nothing is written
+    to DynamoDB or SNS.
+    """
+    records = body.get("batch") or []
+    if len(records) > BATCH_MAX_RECORDS:
+        return 400, {"error": f"batch too large (max {BATCH_MAX_RECORDS} records)"}
+    t0 = time.perf_counter()
+    results = [None] * len(records)
+    sessions = OrderedDict()
+    for i, rec in enumerate(records):
+        if not isinstance(rec, dict):
+            results[i] = {"status": 400, "error": "record must be an object"}
+            continue
+        sid = (rec.get("session_id") or "").strip() or str(uuid.uuid4())
+        sessions.setdefault(sid, []).append((i, {**rec, "session_id": sid}))
+
+    def run(turns):
+        for i, rec in turns:
+            try:
+                code, obj = handle_turn(rec)
+            except Exception as e:
+                code, obj = 502, {"error": str(e)}
+            results[i] = {"status": code, **obj}
+
+    persist = body.get("persist", True) is not False
+    token = _SCRATCH.set(None if persist else {})
+    try:
+        futures = [_BATCH_POOL.submit(contextvars.copy_context().run, run, turns) for turns in sessions.values()]
+    finally:
+        _SCRATCH.reset(token)
+    for f in futures:
+        f.result()
+    return 200, {"results": results, "sessions": len(sessions), "persisted": persist,
+                 "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+def stream_turn(body, write):
+    """Stream a turn as NDJSON lines: {"delta": ...} while generating, then {"done": true, ...response}."""
+    def line(obj): write((json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8"))
+    try:
+        code, obj = handle_turn(body, on_delta=lambda text: line({"delta": text}))
+        line({"done": True, **obj} if code == 200 else obj)
+    except Exception as e:
+        line({"error": str(e)})
+
+def stream_handler(event, response_stream, context=None):
+    """Entry point for hosts that hand us a writable response stream (Lambda response streaming)."""
+    _INVOKE_DEADLINE.set(_invoke_deadline(context))
+    stream_turn(json.loads(event.get("body") or "{}"), response_stream.write)
+
+_COLD = True
+
+def cache_stats():
+    """This container's cache counters, since it started."""
+    return {"faq": faq_cache_stats(), "llm": LLM_CACHE.stats(), "session": SESSION_CACHE.stats()}
+
+def handle_ping(event, cold=False):
+    """Warm-up invoke: {"ping": true, "init": ["dynamodb", "bedrock"]} (or "init": "all")
+    builds the named clients now instead of on a shopper's first turn. The response carries
+    cache_stats(), so a ping also reads the warm container's hit rates."""
+    names = event.get("init") or []
+    if names == "all": names = list(CLIENTS)
+    init_ms = {}
+    for name in names:
+        if name not in CLIENTS: continue
+        t = time.perf_counter()
+        CLIENTS[name].get()
+        init_ms[name] = round((time.perf_counter() - t) * 1000, 2)
+    return {"ok": True, "cold": cold, "init_ms": init_ms,
+            "ready": [n for n, c in CLIENTS.items() if c.ready], "caches": cache_stats()}
+
+def _invoke_deadline(context):
+    """Monotonic time to finish by so the invocation itself doesn't time out, if the host says."""
+    get_ms = getattr(context, "get_remaining_time_in_millis", None)
+    return time.monotonic() + (get_ms() - LAMBDA_MARGIN_MS) / 1000 if get_ms else None
+
+def lambda_handler(event, context):
+    global _COLD
+    cold, _COLD = _COLD, False
+    if event.get("ping"):
+        return handle_ping(event, cold)
+    _INVOKE_DEADLINE.set(_invoke_deadline(context))
+    try:
+        headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+        if "x-shopify-topic" in headers:
+            return handle_shopify_webhook(event, headers)
+        method = event.get("httpMethod") or event.get("requestContext", {}).get("http", {}).get("method")
+        path = event.get("rawPath") or event.get("path") or ""
+        if method == "GET" and path.endswith(FAQ_BUNDLE_PATH):
+            return handle_faq_bundle(headers)
+
+        body = json.loads(event.get("body") or "{}")
+        if isinstance(body.get("batch"), list):
+            return _resp(*handle_batch(body))
+        if isinstance(body.get("faq_log"), list) and not body.get("message"):
+            return _resp(*handle_faq_log(body))
+        if body.get("stream"):
+            # buffered-response invoke: same NDJSON framing, delivered in one body
+            chunks = []
+            stream_turn(body, chunks.append)
+            r = _resp(200, {})
+            r["headers"]["Content-Type"] = "application/x-ndjson"
+            r["body"] = b"".join(chunks).decode("utf-8")
+            return r
+        return _resp(*handle_turn(body))
 
     except Exception as e:
         return _resp(502, {"error": str(e)})
@@ -0,0 +1,40 @@
+# migrate_sessions.py
+"""Backfill the per-turn session table from the legacy HN_Sessions blob items.
+
+Sessions are also migrated lazily on their next turn when SESSION_STORE=turns;
+this script just moves the long tail in one go:
+    python migrate_sessions.py [--dry-run]
+"""
+import argparse
+
+import lambda_function as lf
+
+
+def migrate(dry_run=False):
+    moved = skipped = 0
+    pages = lf.dynamo.get_paginator("scan").paginate(TableName=lf.DDB_TABLE, ProjectionExpression="session_id")
+    for page in pages:
+        for item in page.get("Items", []):
+            session_id = item["session_id"]["S"]
+            if session_id.startswith(lf.RESERVED_KEY_PREFIXES):
+                continue  # order-status cache / escalation outbox / idempotency entries share the table
+            r = lf.dynamo.query(
+                TableName=lf.DDB_TURNS_TABLE,
+                KeyConditionExpression="session_id = :s",
+                ExpressionAttributeValues={":s": {"S": session_id}},
+                Limit=1, Select="COUNT"
+            )
+            if r.get("Count"):
+                skipped += 1
+                continue
+            if not dry_run:
+                session = lf.load_session_blob(session_id)
+                lf.save_session_turns(session_id, session["history"], session["state"])
+            moved += 1
+    print(f"migrated {moved} sessions, {skipped} already in {lf.DDB_TURNS_TABLE}" + (" (dry run)" if dry_run else ""))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--dry-run", action="store_true")
+    migrate(ap.parse_args().dry_run)
@@ -0,0 +1,213 @@
+# server.py
+"""Self-hosted HTTP server for the chatbot: the lambda_handler API on an asyncio event loop.
+
+    python server.py --port 8080 [--workers 16] [--max-inflight 64]
+    python server.py --fake [--fake-latency 20]     # in-process DynamoDB/Bedrock/SNS/Shopify
+
+POST any path with the same JSON body chatbot.js sends; the response is what API Gateway
+would return for the Lambda ({"stream": true} is sent as chunked NDJSON while it generates).
+GET /healthz reports readiness; GET /faq-bundle serves the widget's FAQ bundle. Blocking boto3/Bedrock/Shopify work runs on a bounded thread
+pool; connections are HTTP/1.1 keep-alive; past --max-inflight requests get 503 + Retry-After;
+SIGTERM stops accepting, lets in-flight requests finish (up to --grace seconds) and drains the
+escalation outbox. For DynamoDB Local, point boto3 at it with AWS_ENDPOINT_URL_DYNAMODB.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("OUTBOX_FLUSH", "thread")  # a long-running process: publish from the background thread
+
+import lambda_function as lf
+
+MAX_BODY = 1 << 20
+REASONS = {200: "OK", 204: "No Content", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           408: "Request Timeout", 409: "Conflict", 413: "Payload Too Large", 502: "Bad Gateway", 503: "Service Unavailable"}
+CORS = {"Access-Control-Allow-Origin": "*", "Access-Control-Allow-Headers": "content-type",
+        "Access-Control-Allow-Methods": "POST, GET, OPTIONS"}
+
+
+class BadRequest(Exception):
+    def __init__(self, status, msg):
+        super().__init__(msg)
+        self.status = status
+
+
+class ChatServer:
+    def __init__(self, workers=16, max_inflight=64, idle_timeout=75.0, grace=20.0):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="handler")
+        lf.size_pools(workers)  # each handler thread's session reads, lookups and Bedrock calls
+        self.max_inflight = max_inflight
+        self.idle_timeout = idle_timeout
+        self.grace = grace
+        self.inflight = 0
+        self.served = self.rejected = 0
+        self.closing = False
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.writers = set()
+
+    # ---- HTTP/1.1 ----
+    async def read_request(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise BadRequest(400, "malformed request line")
+        headers = {}
+        while True:
+            h = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            if h in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = h.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise BadRequest(400, "chunked request bodies are not supported")
+        n = int(headers.get("content-length") or 0)
+        if n > MAX_BODY:
+            raise BadRequest(413, "request body too large")
+        body = await asyncio.wait_for(reader.readexactly(n), self.idle_timeout) if n else b""
+        keep_alive = headers.get("connection", "").lower() != "close" and version != "HTTP/1.0"
+        return method, target.split("?", 1)[0], headers, body, keep_alive
+
+    @staticmethod
+    def head(status, headers, keep_alive):
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}"]
+        lines += [f"{k}: {v}" for k, v in {**CORS, **headers}.items()]
+        lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def send(self, writer, status, body, keep_alive, headers=None):
+        data = body if isinstance(body, bytes) else body.encode("utf-8")
+        hdrs = {"Content-Type": "application/json", **(headers or {}), "Content-Length": str(len(data))}
+        writer.write(self.head(status, hdrs, keep_alive) + data)
+        await writer.drain()
+
+    async def send_stream(self, writer, body, keep_alive):
+        """Run stream_turn on the pool and relay its NDJSON lines as HTTP chunks."""
+        loop = asyncio.get_running_loop()
+        q = asyncio.Queue()
+        hdrs = {"Content-Type": "application/x-ndjson", "Transfer-Encoding": "chunked"}
+        writer.write(self.head(200, hdrs, keep_alive))
+        fut = loop.run_in_executor(self.pool, lf.stream_turn, body,
+                                   lambda chunk: loop.call_soon_threadsafe(q.put_nowait, chunk))
+        fut.add_done_callback(lambda _: loop.call_soon_threadsafe(q.put_nowait, None))
+        while (chunk := await q.get()) is not None:
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()  # a slow reader holds this task, not the handler thread
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        await fut
+
+    # ---- requests ----
+    async def dispatch(self, writer, method, path, headers, raw, keep_alive):
+        if method == "OPTIONS":
+            return await self.send(writer, 204, b"", keep_alive)
+        if method == "GET" and path == "/healthz":
+            status = 503 if self.closing else 200
+            return await self.send(writer, status, json.dumps(
+                {"ok": not self.closing, "inflight": self.inflight, "served": self.served,
+                 "rejected": self.rejected, "outbox": lf.OUTBOX.stats(),
+                 "caches": lf.cache_stats()}), keep_alive)
+        if method != "POST" and not (method == "GET" and path == lf.FAQ_BUNDLE_PATH):
+            return await self.send(writer, 405, json.dumps({"error": "method not allowed"}), keep_alive)
+        if self.closing or self.inflight >= self.max_inflight:
+            self.rejected += 1
+            return await self.send(writer, 503, json.dumps({"error": "busy, retry shortly"}),
+                                   keep_alive, {"Retry-After": "1"})
+
+        self.inflight += 1
+        self.idle.clear()
+        try:
+            try:
+                body = json.loads(raw or b"{}")
+            except ValueError:
+                return await self.send(writer, 400, json.dumps({"error": "invalid JSON"}), keep_alive)
+            if isinstance(body, dict) and body.get("stream") and not isinstance(body.get("batch"), list):
+                return await self.send_stream(writer, body, keep_alive)
+            event = {"httpMethod": method, "path": path, "headers": headers,
+                     "body": raw.decode("utf-8", "replace")}
+            if isinstance(body, dict) and body.get("ping"):
+                event = body  # Lambda gets warm-up pings as the raw invoke event
+            r = await asyncio.get_running_loop().run_in_executor(self.pool, lf.lambda_handler, event, None)
+            if "statusCode" not in r:  # ping answers are bare dicts
+                r = {"statusCode": 200, "body": json.dumps(r)}
+            hdrs = {k: v for k, v in (r.get("headers") or {}).items() if k.lower() != "content-length"}
+            await self.send(writer, r["statusCode"], r.get("body") or "", keep_alive, hdrs)
+        finally:
+            self.served += 1
+            self.inflight -= 1
+            if not self.inflight:
+                self.idle.set()
+
+    async def handle_conn(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while not self.closing:
+                try:
+                    req = await self.read_request(reader)
+                except BadRequest as e:
+                    await self.send(writer, e.status, json.dumps({"error": str(e)}), False)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if req is None:
+                    break
+                method, path, headers, raw, keep_alive = req
+                await self.dispatch(writer, method, path, headers, raw, keep_alive and not self.closing)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    # ---- lifecycle ----
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_conn, host, port, reuse_address=True)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        print(f"chatbot server on http://{host}:{server.sockets[0].getsockname()[1]}", flush=True)
+        async with server:
+            await stop.wait()
+            await self.shutdown(server)
+
+    async def shutdown(self, server):
+        self.closing = True
+        server.close()  # stop accepting; idle keep-alive connections see `closing` and drop
+        t = time.monotonic()
+        try:
+            await asyncio.wait_for(self.idle.wait(), self.grace)
+        except asyncio.TimeoutError:
+            print(f"shutdown: {self.inflight} requests still running after {self.grace}s", flush=True)
+        for w in list(self.writers):
+            w.close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        lf.OUTBOX.drain(timeout=max(1.0, self.grace - (time.monotonic() - t)))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    ap.add_argument("--workers", type=int, default=16, help="threads for blocking handler work")
+    ap.add_argument("--max-inflight", type=int, default=64, help="503 beyond this many concurrent requests")
+    ap.add_argument("--idle-timeout", type=float, default=75.0, help="seconds a keep-alive connection may idle")
+    ap.add_argument("--grace", type=float, default=20.0, help="seconds to finish in-flight work on SIGTERM")
+    ap.add_argument("--fake", action="store_true", help="use the in-process fakes from fakes.py")
+    ap.add_argument("--fake-latency", type=float, default=0.0, help="ms added to every fake call")
+    args = ap.parse_args()
+    if args.fake:
+        import fakes
+        fakes.install(lf, latency_ms=args.fake_latency)
+    asyncio.run(ChatServer(args.workers, args.max_inflight, args.idle_timeout, args.grace)
+                .serve(args.host, args.port))
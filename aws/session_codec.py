@@ -0,0 +1,105 @@
+# session_codec.py
+"""Compact binary encoding for stored session history and state (DynamoDB "B" attributes).
+
+    byte 0   format version (FORMAT)
+    byte 1   flags: bit 0 = payload is zlib-compressed
+    rest     compact JSON, compressed when that makes it smaller
+
+History is stored by column instead of as a list of message objects, so the "role", "ts"
+and "intent" keys aren't repeated per message: roles become one-letter codes, timestamps
+are deltas from the previous message, and intents are one entry per message ("" = none).
+Keys a message has beyond role/content/ts/intent/turn are kept in a sparse "x" column.
+"""
+import json
+import zlib
+
+FORMAT = 1
+_ZLIB = 0x01
+MIN_COMPRESS = 64        # bytes; shorter payloads stay uncompressed
+ZLIB_LEVEL = 6
+
+_ROLE = {"user": "u", "assistant": "a", "system": "s"}
+_ROLE_NAME = {v: k for k, v in _ROLE.items()}
+_BASE_KEYS = {"role", "content", "ts", "intent", "turn"}
+
+
+class CodecError(ValueError):
+    pass
+
+
+def pack(obj):
+    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) >= MIN_COMPRESS:
+        z = zlib.compress(raw, ZLIB_LEVEL)
+        if len(z) < len(raw):
+            return bytes((FORMAT, _ZLIB)) + z
+    return bytes((FORMAT, 0)) + raw
+
+
+def unpack(data):
+    data = bytes(data)  # boto3 may hand back a Binary wrapper
+    if len(data) < 2 or data[0] != FORMAT:
+        raise CodecError(f"unknown session encoding (format byte {data[:1]!r})")
+    body = data[2:]
+    try:
+        return json.loads(zlib.decompress(body) if data[1] & _ZLIB else body)
+    except (zlib.error, ValueError) as e:
+        raise CodecError(f"corrupt session payload: {e}") from None
+
+
+def history_columns(history):
+    cols = {"r": [], "c": [], "t": [], "i": []}
+    prev_ts = 0
+    turns, extras = [], []
+    for m in history:
+        cols["r"].append(_ROLE.get(m["role"], m["role"]))
+        cols["c"].append(m["content"])
+        ts = m.get("ts")
+        cols["t"].append(None if ts is None else ts - prev_ts)
+        prev_ts = prev_ts if ts is None else ts
+        cols["i"].append(m.get("intent") or "")
+        turns.append(m.get("turn", 0))
+        extra = {k: v for k, v in m.items() if k not in _BASE_KEYS}
+        extras.append(extra or None)
+    if any(turns):
+        cols["n"] = turns
+    if any(extras):
+        cols["x"] = extras
+    return cols
+
+
+def history_from_columns(cols):
+    history, ts = [], 0
+    turns, extras = cols.get("n"), cols.get("x")
+    for j, (role, content, dt, intent) in enumerate(zip(cols["r"], cols["c"], cols["t"], cols["i"])):
+        m = {"role": _ROLE_NAME.get(role, role), "content": content}
+        if dt is not None:
+            ts += dt
+            m["ts"] = ts
+        if intent:
+            m["intent"] = intent
+        if turns and turns[j]:
+            m["turn"] = turns[j]
+        if extras and extras[j]:
+            m.update(extras[j])
+        history.append(m)
+    return history
+
+
+def encode_session(history, state):
+    return pack({"h": history_columns(history), "s": state})
+
+
+def decode_session(data):
+    """-> (history, state)"""
+    obj = unpack(data)
+    return history_from_columns(obj["h"]), obj.get("s") or {}
+
+
+def encode_message(m):
+    """One message of the per-turn store (its turn number lives in the sort key)."""
+    return pack(history_columns([{k: v for k, v in m.items() if k != "turn"}]))
+
+
+def decode_message(data):
+    return history_from_columns(unpack(data))[0]
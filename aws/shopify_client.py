@@ -0,0 +1,175 @@
+# shopify_client.py
+"""Small Shopify Admin API client for the Lambda.
+
+- keep-alive: one HTTP(S) connection per thread, reused across warm invocations
+- deadlines: every call has a total time budget covering connect, read and retries
+- retries: jittered exponential backoff on 429/5xx/connection errors, honoring Retry-After,
+  and pacing requests off X-Shopify-Shop-Api-Call-Limit before the bucket overflows
+"""
+import http.client
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+
+class ShopifyError(Exception):
+    def __init__(self, status, body=""):
+        super().__init__(f"Shopify HTTP {status}: {body[:200]}")
+        self.status = status
+        self.body = body
+
+
+class ShopifyTimeout(ShopifyError):
+    def __init__(self, msg="deadline exceeded"):
+        super().__init__(0, msg)
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ShopifyClient:
+    def __init__(self, store_url, access_token, api_version="2025-01", deadline=3.0,
+                 max_retries=2, backoff=0.25, leak_rate=2.0, bucket_headroom=0.8):
+        u = urllib.parse.urlsplit(store_url)
+        self.scheme, self.host = u.scheme or "https", u.netloc
+        self.base_path = f"{u.path.rstrip('/')}/admin/api/{api_version}/"
+        self.access_token = access_token
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.leak_rate = leak_rate              # REST bucket drains ~2 calls/s on standard plans
+        self.bucket_headroom = bucket_headroom  # start pacing once the bucket is this full
+        self._local = threading.local()
+        self._bucket_lock = threading.Lock()
+        self._bucket = (0, 40, 0.0)             # (used, limit, observed at)
+
+    # ---- connection pool (one per thread) ----
+    def _conn(self, timeout):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            conn = self._local.conn = cls(self.host, timeout=timeout)
+        else:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+        return conn
+
+    def _drop_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def close(self):
+        self._drop_conn()
+
+    # ---- rate limit bucket ----
+    def _note_call_limit(self, header):
+        try:
+            used, limit = (int(x) for x in header.split("/"))
+        except (AttributeError, ValueError):
+            return
+        with self._bucket_lock:
+            self._bucket = (used, limit, time.monotonic())
+
+    def _bucket_wait(self):
+        """Seconds to wait so the next call lands below bucket_headroom."""
+        with self._bucket_lock:
+            used, limit, at = self._bucket
+        used -= (time.monotonic() - at) * self.leak_rate
+        over = used - limit * self.bucket_headroom
+        return max(0.0, over / self.leak_rate)
+
+    # ---- requests ----
+    def request(self, method, path, params=None, body=None, deadline=None):
+        end = time.monotonic() + (deadline or self.deadline)
+        url = self.base_path + path.lstrip("/")
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        headers = {
+            "X-Shopify-Access-Token": self.access_token,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Connection": "keep-alive",
+        }
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+
+        attempt = 0
+        while True:
+            wait = self._bucket_wait()
+            if wait:
+                _sleep_until(min(time.monotonic() + wait, end))
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise ShopifyTimeout()
+            retry_after = None
+            try:
+                conn = self._conn(remaining)
+                conn.request(method, url, body=payload, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                self._note_call_limit(resp.getheader("X-Shopify-Shop-Api-Call-Limit"))
+                if resp.getheader("Connection", "").lower() == "close":
+                    self._drop_conn()
+                if 200 <= resp.status < 300:
+                    return json.loads(data.decode("utf-8")) if data else {}
+                err = ShopifyError(resp.status, data.decode("utf-8", "replace"))
+                if resp.status not in RETRY_STATUSES:
+                    raise err
+                retry_after = _parse_retry_after(resp.getheader("Retry-After"))
+            except (http.client.HTTPException, OSError) as e:
+                self._drop_conn()  # stale keep-alive socket or timeout: reconnect next attempt
+                err = ShopifyTimeout(str(e)) if isinstance(e, TimeoutError) else ShopifyError(0, str(e))
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise err
+            delay = retry_after if retry_after is not None else self.backoff * (2 ** (attempt - 1))
+            delay *= random.uniform(1.0, 1.5)  # jitter so retries from many containers spread out
+            if time.monotonic() + delay >= end:
+                raise err
+            time.sleep(delay)
+
+    def get(self, path, params=None, deadline=None):
+        return self.request("GET", path, params=params, deadline=deadline)
+
+    def post(self, path, body, deadline=None):
+        return self.request("POST", path, body=body, deadline=deadline)
+
+    def graphql(self, query, variables=None, deadline=None):
+        """POST graphql.json and return `data`; THROTTLED errors wait out the cost bucket and retry."""
+        end = time.monotonic() + (deadline or self.deadline)
+        for attempt in range(self.max_retries + 1):
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise ShopifyTimeout()
+            r = self.post("graphql.json", {"query": query, "variables": variables or {}}, deadline=remaining)
+            errors = r.get("errors")
+            if not errors:
+                return r.get("data") or {}
+            throttled = any((e.get("extensions") or {}).get("code") == "THROTTLED" for e in errors)
+            if not throttled or attempt == self.max_retries:
+                raise ShopifyError(200, json.dumps(errors))
+            cost = (r.get("extensions") or {}).get("cost") or {}
+            status = cost.get("throttleStatus") or {}
+            need = cost.get("requestedQueryCost", 1) - status.get("currentlyAvailable", 0)
+            delay = max(need, 1) / max(status.get("restoreRate", 50), 1) * random.uniform(1.0, 1.5)
+            if time.monotonic() + delay >= end:
+                raise ShopifyTimeout("throttled past deadline")
+            time.sleep(delay)
+
+
+def _parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _sleep_until(t):
+    delay = t - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
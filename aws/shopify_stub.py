@@ -0,0 +1,160 @@
+# shopify_stub.py
+"""Local stand-in for the Shopify Admin REST API, for testing without the network.
+
+    python shopify_stub.py --port 8787 [--latency 0.05] [--throttle-every 5]
+    SHOPIFY_STORE_URL=http://127.0.0.1:8787 python ...
+
+Serves customers/search.json, orders.json, orders/<id>.json and the latest-order
+graphql.json query from in-memory fixtures over HTTP/1.1 keep-alive, reports
+X-Shopify-Shop-Api-Call-Limit, and can inject latency and 429 + Retry-After (or GraphQL
+THROTTLED) throttling. start_stub() runs it in a background thread.
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CUSTOMERS = [
+    {"id": 1001, "email": "jane@example.com", "first_name": "Jane"},
+    {"id": 1002, "email": "new@example.com", "first_name": "Newbie"},
+]
+ORDERS = {
+    1001: [
+        {"id": 5002, "order_number": 1042, "created_at": "2025-09-02T15:04:05Z",
+         "fulfillment_status": "fulfilled",
+         "fulfillments": [{"tracking_number": "1Z999AA10123456784", "tracking_company": "UPS"}],
+         "line_items": [{"title": "Beef Recipe", "quantity": 8}]},
+        {"id": 5001, "order_number": 1001, "created_at": "2025-08-01T10:00:00Z",
+         "fulfillment_status": "fulfilled", "fulfillments": [],
+         "line_items": [{"title": "Starter Box", "quantity": 1}]},
+    ],
+    1002: [],
+}
+
+
+class StubState:
+    def __init__(self, latency=0.0, throttle_every=0, retry_after=1, bucket=40):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.bucket = bucket
+        self.calls = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+    state = StubState()
+
+    def setup(self):
+        super().setup()
+        with self.state.lock:
+            self.state.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, obj, extra=None):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (extra or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self):
+        """Count the call, apply latency; returns (call-limit headers, throttled?)."""
+        st = self.state
+        with st.lock:
+            st.calls += 1
+            n = st.calls
+        if st.latency:
+            time.sleep(st.latency)
+        limit = {"X-Shopify-Shop-Api-Call-Limit": f"{min(n, st.bucket)}/{st.bucket}"}
+        return limit, bool(st.throttle_every and n % st.throttle_every == 0)
+
+    def do_GET(self):
+        limit, throttled = self._begin()
+        if throttled:
+            return self._send(429, {"errors": "Exceeded 2 calls per second for api client."},
+                              {**limit, "Retry-After": str(self.state.retry_after)})
+
+        url = urllib.parse.urlsplit(self.path)
+        qs = urllib.parse.parse_qs(url.query)
+        if url.path.endswith("/customers/search.json"):
+            email = qs.get("query", [""])[0].removeprefix("email:")
+            return self._send(200, {"customers": [c for c in CUSTOMERS if c["email"] == email]}, limit)
+        if url.path.endswith("/orders.json"):
+            cid = int(qs.get("customer_id", ["0"])[0])
+            return self._send(200, {"orders": ORDERS.get(cid, [])}, limit)
+        if "/orders/" in url.path:  # orders/<id>.json
+            oid = url.path.rsplit("/", 1)[1].removesuffix(".json")
+            for cid, orders in ORDERS.items():
+                for o in orders:
+                    if str(o["id"]) == oid:
+                        email = next(c["email"] for c in CUSTOMERS if c["id"] == cid)
+                        return self._send(200, {"order": {**o, "email": email, "customer": {"id": cid, "email": email}}}, limit)
+        return self._send(404, {"errors": "Not Found"}, limit)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        _, throttled = self._begin()
+        if not self.path.endswith("/graphql.json"):
+            return self._send(404, {"errors": "Not Found"})
+        cost = {"requestedQueryCost": 5, "actualQueryCost": 5,
+                "throttleStatus": {"maximumAvailable": 2000.0, "currentlyAvailable": 0 if throttled else 1995,
+                                   "restoreRate": 100.0}}
+        if throttled:
+            return self._send(200, {"errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+                                    "extensions": {"cost": cost}})
+        # Only the latest-order lookup is modelled; the query text itself isn't parsed.
+        email = (body.get("variables") or {}).get("query", "").removeprefix("email:")
+        edges = []
+        for c in CUSTOMERS:
+            if c["email"] != email:
+                continue
+            orders = sorted(ORDERS.get(c["id"], []), key=lambda o: o["created_at"], reverse=True)[:1]
+            edges.append({"node": {"id": f"gid://shopify/Customer/{c['id']}",
+                                   "orders": {"edges": [{"node": gql_order(o)} for o in orders]}}})
+        return self._send(200, {"data": {"customers": {"edges": edges[:1]}}, "extensions": {"cost": cost}})
+
+
+def gql_order(o):
+    status = {"fulfilled": "FULFILLED", "partial": "PARTIALLY_FULFILLED"}.get(o.get("fulfillment_status"), "UNFULFILLED")
+    return {
+        "name": f"#{o['order_number']}",
+        "createdAt": o["created_at"],
+        "displayFulfillmentStatus": status,
+        "fulfillments": [{"trackingInfo": [{"number": f.get("tracking_number"), "company": f.get("tracking_company")}]}
+                         for f in o.get("fulfillments", [])[:1]],
+    }
+
+
+def start_stub(port=0, **state):
+    """Serve in a daemon thread; returns (server, base_url). server.shutdown() to stop."""
+    handler = type("StubHandler", (Handler,), {"state": StubState(**state)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local Shopify Admin API stub")
+    ap.add_argument("--port", type=int, default=8787)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    ap.add_argument("--throttle-every", type=int, default=0, help="answer every Nth call with 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    args = ap.parse_args()
+    Handler.state = StubState(args.latency, args.throttle_every, args.retry_after)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    print(f"Shopify stub on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
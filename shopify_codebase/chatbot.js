@@ -24,7 +24,11 @@
   const getCfg = () => ({
     endpoint   : resolveEndpoint(),
     shop       : root?.dataset.shop,
-    customerId : root?.dataset.customerId || null
+    customerId : root?.dataset.customerId || null,
+    // stream LLM replies token by token (backend answers with NDJSON)
+    stream     : String(root?.dataset?.stream ?? window.GWCB_CFG?.stream ?? '') === 'true',
+    // GET URL of the backend's FAQ bundle; empty turns local FAQ answers off
+    faqBundle  : (root?.dataset?.faqBundle || window.GWCB_CFG?.faqBundle || '').trim()
   });
 
   // ------- Session id -------
@@ -135,6 +139,167 @@
     );
   }
 
+  // ------- Local FAQ answers (bundle from the backend, same char n-grams as its index) -------
+  let faqBundle = null;
+  let lastServer = { intent: null, resolved: false };  // an open order-status flow stays on the server
+  const CJK_RE = /[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+/g;
+
+  function addLatinGrams(s, out) {
+    s = s.trim();
+    if (!s) return;
+    s = ` ${s} `;
+    for (let i = 0; i + 3 <= s.length; i++) out.add(s.slice(i, i + 3));
+  }
+
+  // trigrams for Latin runs; unigrams + bigrams for CJK runs (lambda_function.char_ngrams)
+  function charNgrams(s) {
+    const out = new Set();
+    let pos = 0;
+    for (const m of s.matchAll(CJK_RE)) {
+      addLatinGrams(s.slice(pos, m.index), out);
+      const run = m[0];
+      for (let i = 0; i < run.length; i++) out.add(run[i]);
+      for (let i = 0; i + 2 <= run.length; i++) out.add(run.slice(i, i + 2));
+      pos = m.index + run.length;
+    }
+    addLatinGrams(s.slice(pos), out);
+    return out;
+  }
+
+  async function loadFaqBundle() {
+    const url = getCfg().faqBundle;
+    if (!url) return;
+    try {
+      const res = await fetch(url, { credentials: 'omit' });  // HTTP cache / ETag revalidation
+      if (!res.ok) return;
+      const data = await res.json();
+      data.faqs.forEach((f) => { f.grams = f.m.map(charNgrams); });
+      faqBundle = data;
+    } catch (err) {
+      console.warn('[chatbot] FAQ bundle unavailable', err);
+    }
+  }
+
+  // best FAQ by Dice overlap if it clears the bundle's threshold; null sends the message to the server
+  function matchLocal(text) {
+    if (!faqBundle || !(faqBundle.threshold > 0)) return null;
+    if (lastServer.intent === 'order_status' && !lastServer.resolved) return null;
+    const msg = text.replace(/\s+/g, ' ').trim().toLowerCase();
+    if (msg.includes('@') || faqBundle.server_keywords.some((k) => msg.includes(k))) return null;
+    const q = charNgrams(msg);
+    if (!q.size) return null;
+    let best = null, bestScore = 0;
+    for (const f of faqBundle.faqs) {
+      for (const g of f.grams) {
+        let shared = 0;
+        for (const x of q) if (g.has(x)) shared++;
+        const score = (2 * shared) / (q.size + g.size);
+        if (score > bestScore) { bestScore = score; best = f; }  // ties keep the earlier FAQ, like the server
+      }
+    }
+    return bestScore >= faqBundle.threshold ? best : null;
+  }
+
+  function noteServerReply(data) {
+    if (data?.intent) lastServer = { intent: data.intent, resolved: !!data.state?.resolved };
+  }
+
+  // ------- Local answers are reported in batches (or with the next server request) -------
+  const LOG_FLUSH_MS = 5000;
+  const LOG_MAX      = 10;
+  let logQueue = [], logTimer = null;
+
+  function takeLog() {
+    clearTimeout(logTimer);
+    logTimer = null;
+    return logQueue.splice(0);
+  }
+
+  // a send that failed puts its records back in front, for the next flush or request
+  function requeueLog(recs) {
+    if (!recs || !recs.length) return;
+    logQueue.unshift(...recs);
+    if (!logTimer) logTimer = setTimeout(flushLog, LOG_FLUSH_MS);
+  }
+
+  function flushLog() {
+    const endpoint = getCfg().endpoint;
+    if (!logQueue.length || !endpoint) return;
+    const recs = takeLog();
+    const body = JSON.stringify({ faq_log: recs });
+    // text/plain beacon: no CORS preflight, and it survives the page going away
+    if (!(navigator.sendBeacon && navigator.sendBeacon(endpoint, body))) {
+      fetch(endpoint, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body, keepalive: true })
+        .then((res) => { if (!res.ok) throw new Error(`HTTP ${res.status}`); })
+        .catch((err) => { console.warn('[chatbot] FAQ log not sent', err); requeueLog(recs); });
+    }
+  }
+
+  function logLocal(rec) {
+    logQueue.push(rec);
+    if (logQueue.length >= LOG_MAX) flushLog();
+    else if (!logTimer) logTimer = setTimeout(flushLog, LOG_FLUSH_MS);
+  }
+
+  window.addEventListener('pagehide', flushLog);
+  document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') flushLog();
+  });
+  loadFaqBundle();
+
+  // ------- Streaming reply: NDJSON {"delta": "..."} lines, then {"done": true, ...} -------
+  async function renderStream(res) {
+    const reader  = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buf = '', text = '', el = null;
+
+    const handleLine = (line) => {
+      if (!line.trim()) return;
+      let evt;
+      try { evt = JSON.parse(line); } catch { return; }
+      if (evt.delta) {
+        if (!el) { setTyping(false); el = appendMsg('bot', ''); }
+        text += evt.delta;
+        el.textContent = text;   // plain text while streaming
+        log.scrollTop = log.scrollHeight;
+        return;
+      }
+      const reply = evt.error ? 'Connection error. Please try again.' : (pickReply(evt) || text || '…');
+      noteServerReply(evt);
+      setTyping(false);
+      if (el) el.innerHTML = reply;  // final reply may carry links
+      else el = appendMsg('bot', reply);
+    };
+
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buf += decoder.decode(value, { stream: true });
+      const lines = buf.split('\n');
+      buf = lines.pop();
+      lines.forEach(handleLine);
+    }
+    handleLine(buf + decoder.decode());
+    setTyping(false);
+  }
+
+  // ------- Send with retries: every attempt carries the same request_id, so the backend
+  // replays its stored reply instead of handling the message twice (409 = first still running) -------
+  const RETRY_STATUS = [409, 502, 503, 504];
+  const RETRY_DELAYS = [600, 1500];
+
+  async function postWithRetry(url, opts) {
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const res = await fetch(url, opts);
+        if (!RETRY_STATUS.includes(res.status) || attempt >= RETRY_DELAYS.length) return res;
+      } catch (err) {
+        if (attempt >= RETRY_DELAYS.length) throw err;
+      }
+      await new Promise((r) => setTimeout(r, RETRY_DELAYS[attempt]));
+    }
+  }
+
   // ------- Send message flow -------
   async function sendMessage(text) {
     const cfg = getCfg();
@@ -146,21 +311,42 @@
     if (!text || !text.trim()) return;
 
     appendMsg('user', text.trim());
-    setTyping(true);
     if (input) input.value = '';
 
+    const local = matchLocal(text);
+    if (local) {
+      appendMsg('bot', local.a);
+      logLocal({ session_id: sessionId, message: text.trim(), faq_id: local.id,
+                 ts: Math.floor(Date.now() / 1000) });
+      return;
+    }
+    setTyping(true);
+
+    const faqLog = logQueue.length ? takeLog() : undefined;  // recorded ahead of this message
+    let answered = false;
     try {
-      const res = await fetch(cfg.endpoint, {
+      const res = await postWithRetry(cfg.endpoint, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         credentials: 'include', // remove if you don't need cookies
         body: JSON.stringify({
           message: text.trim(),
           session_id: sessionId,   // <<< use snake_case to match backend
+          request_id: crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`,
           customerId: cfg.customerId,
-          shop: cfg.shop
+          shop: cfg.shop,
+          stream: cfg.stream,
+          faq_log: faqLog
         })
       });
+      answered = true;
+      if (!res.ok) requeueLog(faqLog);  // the server didn't store the turn, nor these
+
+      const ctype = res.headers.get('content-type') || '';
+      if (cfg.stream && res.body && ctype.includes('ndjson')) {
+        await renderStream(res);
+        return;
+      }
 
       const raw = await res.text();
       console.log('[chatbot] status', res.status, 'raw:', raw);
@@ -170,10 +356,12 @@
       catch { data = { response: 'Invalid JSON from server' }; }
 
       const reply = pickReply(data);
+      noteServerReply(data);
       setTyping(false);
       appendMsg('bot', reply || '…');
     } catch (err) {
       console.error('[chatbot] network error', err);
+      if (!answered) requeueLog(faqLog);  // a broken stream after a 2xx was stored already
       setTyping(false);
       appendMsg('bot', 'Connection error. Please try again.');
     }